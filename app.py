@@ -1,23 +1,74 @@
+import hmac
+import os
 import time
 
+import modules.metrics as metrics
+import modules.profiler as profiler
+import modules.utils as utils
 import pandas as pd
 from dotenv import load_dotenv
 from flasgger import Swagger
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
-from modules.attribute_finder import LocationAttributeFinder
+from modules.attribute_finder import InvalidFieldsError, LocationAttributeFinder
+from modules.data_reader import S3DataReader
+from modules.generation import GenerationManager
 from modules.model import Model
+from modules.process_memory import get_memory
+from modules.serializer import encode, negotiate
+from modules.startup_loader import StartupLoader
 
 load_dotenv()
 
-model = Model()
-finder = LocationAttributeFinder()
+# Most points a single /features/batch request may ask for
+MAX_BATCH_POINTS = int(os.environ.get('AVM_MAX_BATCH_POINTS', 1000))
+
+reader = S3DataReader()
+
+
+def build_generation(version, previous):
+    # The model downloads while the finders load. Cached responses are kept
+    # across generations, told apart by the version of their datasets.
+    cache = previous.finder.cache if previous is not None else None
+
+    loader = StartupLoader()
+    loader.add('model', lambda _: Model(reader))
+    loader.add('finder', lambda _: LocationAttributeFinder(
+        reader, cache=cache, version=version))
+
+    return loader.run(), loader.timings
+
+
+generations = GenerationManager(
+    reader, build_generation, LocationAttributeFinder.datasets + (Model.model_name,))
 
 app = Flask(__name__)
 swagger = Swagger(app)
 CORS(app)
 
 
+@app.before_request
+def start_watching():
+    # Started from the first request rather than at import, so that with a
+    # preloaded app each forked worker runs its own watcher
+    generations.watch()
+
+
+@app.before_request
+def start_timer():
+    # Stages timed while serving the request are recorded against its endpoint
+    metrics.endpoint.set(request.endpoint or '')
+    g.timer = utils.Timer()
+    g.timer.start()
+
+
+@app.teardown_request
+def stop_timer(exception=None):
+    timer = g.pop('timer', None)
+    if timer is not None:
+        metrics.registry.observe('request', timer.elapsed())
+
+
 @app.route('/')
 def index():
     """
@@ -57,7 +108,151 @@ def get_load_status():
       200:
         description: Returns the load status
     """
-    return finder.get_load_status()
+    return {**generations.current.finder.get_load_status(), 'generation': generations.get_status(),
+            'process': {'pid': os.getpid(), 'memory': get_memory()}}
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    Get metrics
+    ---
+    tags:
+      - Status
+    responses:
+      200:
+        description: Returns the stage latency histograms and load times in Prometheus text format
+    """
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/reload', methods=['POST'])
+def reload():
+    """
+    Reload the datasets and model
+    ---
+    tags:
+      - Status
+    parameters:
+      - name: Authorization
+        in: header
+        type: string
+        required: true
+        description: Bearer followed by the AVM_ADMIN_TOKEN
+    responses:
+      202:
+        description: A new generation is being built in the background, and every other worker is asked to build one
+      403:
+        description: Missing or invalid token
+      409:
+        description: A reload is already in progress
+    """
+    if not authorised():
+        return jsonify({'error': 'Forbidden'}), 403
+
+    if not generations.request_reload():
+        return jsonify({'error': 'Reload already in progress'}), 409
+
+    return jsonify(generations.get_status()), 202
+
+
+# Profiling is opt in with AVM_PROFILING, and nothing below is registered
+# without it, so a worker that does not profile pays nothing for it
+if profiler.is_enabled():
+    @app.before_request
+    def start_profile():
+        # Any request given profile=1 by an admin is answered with its
+        # cProfile report instead of its response
+        if request.args.get('profile') != '1':
+            return None
+
+        if not authorised():
+            return jsonify({'error': 'Forbidden'}), 403
+
+        request_profiler = profiler.RequestProfiler()
+        if not request_profiler.start():
+            return jsonify({'error': 'Another request is being profiled'}), 409
+
+        g.profiler = request_profiler
+        return None
+
+    @app.after_request
+    def report_profile(response):
+        request_profiler = g.pop('profiler', None)
+        if request_profiler is None:
+            return response
+
+        request_profiler.stop()
+        sort = request.args.get('profile_sort', 'cumulative')
+        limit = request.args.get('profile_limit', 50, type=int)
+        if sort not in profiler.SORT_KEYS:
+            sort = 'cumulative'
+
+        return Response(request_profiler.report(sort, limit), content_type=profiler.CONTENT_TYPE,
+                        headers={'X-Profiled-Status': str(response.status_code)})
+
+    @app.teardown_request
+    def stop_profile(exception=None):
+        # after_request is skipped when the request raised
+        request_profiler = g.pop('profiler', None)
+        if request_profiler is not None:
+            request_profiler.stop()
+
+    @app.route('/profile/sampler', methods=['GET', 'POST', 'DELETE'])
+    def sample_stacks():
+        """
+        Sample the stacks of this worker
+        ---
+        tags:
+          - Status
+        parameters:
+          - name: Authorization
+            in: header
+            type: string
+            required: true
+            description: Bearer followed by the AVM_ADMIN_TOKEN
+          - name: interval
+            in: query
+            type: number
+            required: false
+            description: Seconds between samples when starting (default 0.005)
+          - name: duration
+            in: query
+            type: number
+            required: false
+            description: Seconds before the sampler stops by itself when starting (default 30, at most 600)
+        responses:
+          200:
+            description: The stacks sampled so far in collapsed format, stopping the sampler on DELETE
+          202:
+            description: The sampler has started
+          403:
+            description: Missing or invalid token
+          409:
+            description: The sampler is already running
+          500:
+            description: Invalid parameters
+        """
+        if not authorised():
+            return jsonify({'error': 'Forbidden'}), 403
+
+        if request.method == 'POST':
+            interval = request.args.get('interval', profiler.DEFAULT_INTERVAL, type=float)
+            duration = request.args.get('duration', profiler.DEFAULT_DURATION, type=float)
+            if interval <= 0 or duration <= 0:
+                return jsonify({'error': 'Invalid parameters'}), 500
+
+            if not profiler.sampler.start(interval, duration):
+                return jsonify({'error': 'Sampler already running'}), 409
+
+            return jsonify(profiler.sampler.get_status()), 202
+
+        if request.method == 'DELETE':
+            profiler.sampler.stop()
+
+        status = profiler.sampler.get_status()
+        return Response(profiler.sampler.collapsed(), content_type=profiler.CONTENT_TYPE,
+                        headers={'X-Profiler-PID': str(status['pid']), 'X-Profiler-Samples': str(status['samples'])})
 
 
 @app.route('/epc', methods=['GET'])
@@ -83,21 +278,28 @@ def epc():
         type: integer
         required: true
         description: The top n closest matches
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of fields to return
     responses:
       200:
         description: Returns the top n closest match of the given latitude and longitude
       500:
         description: Invalid parameters
     """
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
+    lat = request.args.get('lat', type=utils.finite_float)
+    lon = request.args.get('lon', type=utils.finite_float)
     top_n = request.args.get('top', type=int)
+    fields = request.args.get('fields', type=utils.split_fields)
 
     # Check if values are valid
     if lat is None or lon is None or top_n is None:
         return jsonify({'error': 'Invalid parameters'}), 500
 
-    return finder.find_epc(lat=lat, lon=lon, top_n=top_n)
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(generations.current.finder.find_epc(lat=lat, lon=lon, top_n=top_n, fields=fields, mimetype=mimetype), mimetype=mimetype)
 
 
 @app.route('/transports', methods=['GET'])
@@ -123,21 +325,28 @@ def transports():
         type: integer
         required: true
         description: The radius
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of fields to return
     responses:
       200:
         description: Returns the number of public transport access points within the given radius of the given latitude and longitude
       500:
         description: Invalid parameters
     """
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
+    lat = request.args.get('lat', type=utils.finite_float)
+    lon = request.args.get('lon', type=utils.finite_float)
     radius = request.args.get('radius', type=int)
+    fields = request.args.get('fields', type=utils.split_fields)
 
     # Check if values are valid
     if lat is None or lon is None or radius is None:
         return jsonify({'error': 'Invalid parameters'}), 500
 
-    return finder.find_transport(lat=lat, lon=lon, radius=radius)
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(generations.current.finder.find_transport(lat=lat, lon=lon, radius=radius, fields=fields, mimetype=mimetype), mimetype=mimetype)
 
 
 @app.route('/schools', methods=['GET'])
@@ -163,21 +372,28 @@ def schools():
         type: integer
         required: true
         description: The radius
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of fields to return
     responses:
       200:
         description: Returns the schools within the given radius of the given latitude and longitude
       500:
         description: Invalid parameters
     """
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
+    lat = request.args.get('lat', type=utils.finite_float)
+    lon = request.args.get('lon', type=utils.finite_float)
     radius = request.args.get('radius', type=int)
+    fields = request.args.get('fields', type=utils.split_fields)
 
     # Check if values are valid
     if lat is None or lon is None or radius is None:
         return jsonify({'error': 'Invalid parameters'}), 500
 
-    return finder.find_schools(lat=lat, lon=lon, radius=radius)
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(generations.current.finder.find_schools(lat=lat, lon=lon, radius=radius, fields=fields, mimetype=mimetype), mimetype=mimetype)
 
 
 @app.route('/greenspace', methods=['GET'])
@@ -203,21 +419,28 @@ def greenspace():
         type: integer
         required: true
         description: The top n green spaces
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of fields to return
     responses:
       200:
         description: Returns the top n closest match of the given latitude and longitude
       500:
         description: Invalid parameters
     """
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
+    lat = request.args.get('lat', type=utils.finite_float)
+    lon = request.args.get('lon', type=utils.finite_float)
     top_n = request.args.get('top', type=int)
+    fields = request.args.get('fields', type=utils.split_fields)
 
     # Check if values are valid
     if lat is None or lon is None or top_n is None:
         return jsonify({'error': 'Invalid parameters'}), 500
 
-    return finder.find_green_space(lat=lat, lon=lon, top_n=top_n)
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(generations.current.finder.find_green_space(lat=lat, lon=lon, top_n=top_n, fields=fields, mimetype=mimetype), mimetype=mimetype)
 
 
 @app.route('/imd', methods=['GET'])
@@ -243,21 +466,28 @@ def imd():
         type: integer
         required: true
         description: The top n closest matches
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of fields to return
     responses:
       200:
         description: Returns the top n closest match of the given latitude and longitude
       500:
         description: Invalid parameters
     """
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
+    lat = request.args.get('lat', type=utils.finite_float)
+    lon = request.args.get('lon', type=utils.finite_float)
     top_n = request.args.get('top', type=int)
+    fields = request.args.get('fields', type=utils.split_fields)
 
     # Check if values are valid
     if lat is None or lon is None or top_n is None:
         return jsonify({'error': 'Invalid parameters'}), 500
 
-    return finder.find_imd(lat=lat, lon=lon, top_n=top_n)
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(generations.current.finder.find_imd(lat=lat, lon=lon, top_n=top_n, fields=fields, mimetype=mimetype), mimetype=mimetype)
 
 
 @app.route('/features', methods=['GET'])
@@ -283,21 +513,91 @@ def features():
         type: integer
         required: false
         description: The radius  
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated list of fields to return
     responses:
       200:
         description: Returns all features for a given latitude and longitude
       500:
         description: Invalid parameters
     """
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
+    lat = request.args.get('lat', type=utils.finite_float)
+    lon = request.args.get('lon', type=utils.finite_float)
     radius = request.args.get('radius', type=int) or 804
+    fields = request.args.get('fields', type=utils.split_fields)
 
     # Check if values are valid
     if lat is None or lon is None:
         return jsonify({'error': 'Invalid parameters'}), 500
 
-    return finder.find_all(lat=lat, lon=lon, radius=radius)
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(generations.current.finder.find_all(lat=lat, lon=lon, radius=radius, fields=fields, mimetype=mimetype), mimetype=mimetype)
+
+
+@app.route('/features/batch', methods=['POST'])
+def features_batch():
+    """
+    Get All Features for many locations
+    ---
+    tags:
+      - All
+    parameters:
+      - in: body
+        name: payload
+        required: true
+        schema:
+          type: object
+          properties:
+            points:
+              type: array
+              items:
+                type: object
+                properties:
+                  lat:
+                    type: number
+                  lon:
+                    type: number
+            radius:
+              type: integer
+            fields:
+              type: array
+              items:
+                type: string
+    responses:
+      200:
+        description: Returns all features for each of the given latitude and longitude pairs, in the same order
+      500:
+        description: Invalid parameters
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Invalid parameters'}), 500
+
+    points = payload.get('points')
+    radius = payload.get('radius') or 804
+    fields = payload.get('fields')
+
+    try:
+        central_points = [(utils.finite_float(point['lat']), utils.finite_float(point['lon']))
+                          for point in points]
+        radius = int(radius)
+        if isinstance(fields, str):
+            fields = utils.split_fields(fields)
+    except (TypeError, KeyError, ValueError, OverflowError):
+        return jsonify({'error': 'Invalid parameters'}), 500
+
+    # Either a comma separated string or a list of field names
+    if fields is not None and not (isinstance(fields, list) and all(isinstance(field, str) for field in fields)):
+        return jsonify({'error': 'Invalid parameters'}), 500
+
+    if not central_points or len(central_points) > MAX_BATCH_POINTS:
+        return jsonify({'error': 'Invalid parameters'}), 500
+
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(generations.current.finder.find_all_batch(central_points=central_points, radius=radius, fields=fields, mimetype=mimetype), mimetype=mimetype)
 
 
 @app.route('/predict', methods=['POST'])
@@ -321,17 +621,76 @@ def predict():
         description: Returns the prediction
     """
     try:
-        df = pd.DataFrame([request.json])
+        df = to_prediction_frame([request.json])
+
+        return respond({"prediction": generations.current.model.predict(df)})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    """
+    Predict house prices for many properties
+    ---
+    tags:
+      - Prediction
+    parameters:
+      - in: body
+        name: payload
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+            properties:
+              EPC_TOTAL_FLOOR_AREA:
+                type: number
+    responses:
+      200:
+        description: Returns the predictions in the same order as the given records
+      400:
+        description: Invalid records
+    """
+    try:
+        records = request.json
 
-        if 'PPD_TransferDate' in df.columns:
-            df['PPD_TransferDate'] = pd.to_datetime(
-                df['PPD_TransferDate'], unit='ms')
+        if not isinstance(records, list) or not records:
+            return jsonify({"error": "Expected a non-empty list of records"}), 400
 
-        return jsonify({"prediction": model.predict(df)}), 200
+        return respond({"predictions": generations.current.model.predict_batch(to_prediction_frame(records))})
 
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 
+@app.errorhandler(InvalidFieldsError)
+def invalid_fields(e):
+    return jsonify({'error': str(e)}), 500
+
+
+def authorised():
+    # Admin endpoints are disabled unless AVM_ADMIN_TOKEN is set
+    token = os.environ.get('AVM_ADMIN_TOKEN')
+    given = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(given.encode(), f'Bearer {token}'.encode())
+
+
+def respond(value):
+    mimetype = negotiate(request.accept_mimetypes)
+    return Response(encode(value, mimetype), mimetype=mimetype), 200
+
+
+def to_prediction_frame(records):
+    df = pd.DataFrame(records)
+
+    if 'PPD_TransferDate' in df.columns:
+        df['PPD_TransferDate'] = pd.to_datetime(
+            df['PPD_TransferDate'], unit='ms')
+
+    return df
+
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,130 @@
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as wsgi_app
+
+
+class BoundedWSGIAdapter:
+    # Serves a WSGI app to an ASGI server. The event loop only accepts
+    # connections and moves bytes; every request runs the Flask app, and so
+    # the finder and model work, on a pool of at most max_threads threads.
+    # Requests beyond max_pending waiting for a thread are turned away with a
+    # 503 rather than queueing up latency.
+    def __init__(self, app, max_threads=None, max_pending=None):
+        self.app = app
+        self.max_threads = max_threads or int(os.environ.get(
+            'AVM_ASGI_THREADS', 0)) or (os.cpu_count() or 1)
+        self.max_pending = int(os.environ.get(
+            'AVM_ASGI_MAX_PENDING', 0)) if max_pending is None else max_pending
+        self.executor = None
+        self.pending = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.__lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported scope type: {scope["type"]}')
+
+        # The pool is created in the worker process, after any fork
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.max_threads, thread_name_prefix='asgi')
+
+        if self.max_pending and self.pending >= self.max_threads + self.max_pending:
+            return await BoundedWSGIAdapter.__send(send, 503, [(b'content-type', b'application/json')],
+                                                   b'{"error":"Server busy"}')
+
+        body = await BoundedWSGIAdapter.__read_body(receive)
+
+        self.pending += 1
+        try:
+            status, headers, content = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.__run, BoundedWSGIAdapter.__environ(scope, body))
+        finally:
+            self.pending -= 1
+
+        await BoundedWSGIAdapter.__send(send, status, headers, content)
+
+    def __run(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        chunks = self.app(environ, start_response)
+        try:
+            content = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        return response['status'], response['headers'], content
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def __read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    @staticmethod
+    async def __send(send, status, headers, content):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    @staticmethod
+    def __environ(scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+                environ[name] = value
+                continue
+
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+        return environ
+
+
+app = BoundedWSGIAdapter(wsgi_app)
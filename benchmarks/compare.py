@@ -0,0 +1,46 @@
+import argparse
+import json
+import sys
+
+
+def compare(baseline, current, threshold):
+    # Rows of (metric, baseline, current, relative change, regressed) for the
+    # metrics where lower is better
+    metrics = [('start_up.cold', baseline['start_up']['cold']['total'], current['start_up']['cold']['total']),
+               ('start_up.warm', baseline['start_up']['warm']['total'], current['start_up']['warm']['total']),
+               ('peak_rss_mb', baseline['peak_rss'] / 1024 ** 2, current['peak_rss'] / 1024 ** 2)]
+
+    for endpoint, result in current['endpoints'].items():
+        if endpoint not in baseline['endpoints']:
+            continue
+        # p99 of a few hundred calls is too noisy to gate on
+        for name in ('p50_ms', 'p95_ms'):
+            metrics.append((f'{endpoint}.{name}', baseline['endpoints'][endpoint][name], result[name]))
+
+    return [(name, old, new, new / old - 1 if old else 0.0, old > 0 and new / old - 1 > threshold)
+            for name, old, new in metrics]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark results and fail on regressions')
+    parser.add_argument('baseline', help='results of the baseline commit')
+    parser.add_argument('current', help='results to check')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative increase counted as a regression (default 0.1)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    if baseline['scale'] != current['scale']:
+        print(f'Warning: comparing scale {baseline["scale"]} against {current["scale"]}')
+
+    rows = compare(baseline, current, args.threshold)
+    for name, old, new, change, regressed in rows:
+        print(f'{name:32} {old:14.3f} {new:14.3f} {change:+8.1%}{"  REGRESSION" if regressed else ""}')
+
+    regressions = sum(regressed for *_, regressed in rows)
+    print(f'{baseline.get("commit")} -> {current.get("commit")}: {regressions} regressions')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from benchmarks.run import ensure_datasets
+from benchmarks.s3_server import S3Server
+from benchmarks.synthetic import training_frame
+
+DEFAULT_MIX = {'features': 0.6, 'epc': 0.3, 'predict': 0.1}
+
+# Latency objectives in milliseconds, per endpoint and percentile
+DEFAULT_SLOS = {'features': {'p95': 250}, 'epc': {'p95': 250}, 'predict': {'p95': 500}}
+
+DEFAULT_MAX_ERROR_RATE = 0.01
+
+SERVER_COMMANDS = {
+    'gunicorn': ['-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'app:app'],
+    'asgi': ['-m', 'gunicorn', '--config', 'gunicorn.conf.py', '-k', 'uvicorn.workers.UvicornWorker', 'asgi:app']
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RequestFactory:
+    # Requests of each endpoint at addresses drawn from the ONS UPRN
+    # directory, so that they cluster where people live as real traffic does
+    def __init__(self, data_dir, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.points = pd.read_parquet(os.path.join(data_dir, 'london_onsud_uprn.parquet'),
+                                      columns=['UPRN_LATITUDE', 'UPRN_LONGITUDE']).to_numpy()
+
+    def __point(self):
+        with self.lock:
+            return self.points[self.rng.integers(0, len(self.points))]
+
+    def make(self, endpoint):
+        # (method, path, JSON body) of one request
+        lat, lon = self.__point()
+
+        if endpoint == 'features':
+            return 'GET', f'/features?lat={lat}&lon={lon}', None
+        if endpoint == 'epc':
+            return 'GET', f'/epc?lat={lat}&lon={lon}&top=5', None
+        if endpoint == 'transports':
+            return 'GET', f'/transports?lat={lat}&lon={lon}&radius=800', None
+        if endpoint == 'schools':
+            return 'GET', f'/schools?lat={lat}&lon={lon}&radius=800', None
+        if endpoint == 'greenspace':
+            return 'GET', f'/greenspace?lat={lat}&lon={lon}&top=5', None
+        if endpoint == 'imd':
+            return 'GET', f'/imd?lat={lat}&lon={lon}&top=5', None
+        if endpoint == 'predict':
+            with self.lock:
+                record = training_frame(self.rng, 1)
+            # Transfer dates are sent in milliseconds since the epoch
+            record['PPD_TransferDate'] = record['PPD_TransferDate'].astype('datetime64[ms]').astype(np.int64)
+            return 'POST', '/predict', record.to_dict(orient='records')[0]
+
+        raise ValueError(f'Unknown endpoint: {endpoint}')
+
+
+def send(url, method, path, body, timeout):
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(url + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'} if data else {})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status < 400
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def run_at_rate(url, factory, mix, rate, duration, concurrency, timeout, arrivals, seed):
+    # Open loop: requests are sent at their scheduled times whether or not
+    # earlier ones have finished, and latency is counted from the scheduled
+    # time, so a slow server cannot hide its queueing delay
+    rng = np.random.default_rng(seed)
+    count = int(rate * duration)
+    gaps = rng.exponential(1 / rate, count) if arrivals == 'poisson' else np.full(count, 1 / rate)
+    schedule = np.cumsum(gaps) - gaps[0]
+    endpoints = rng.choice(list(mix), count, p=np.array(list(mix.values())) / sum(mix.values()))
+
+    results = []
+    lock = threading.Lock()
+
+    def call(endpoint, request, scheduled):
+        ok = send(url, *request, timeout)
+        latency = time.perf_counter() - scheduled
+        with lock:
+            results.append((endpoint, latency, ok))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for offset, endpoint in zip(schedule, endpoints):
+            request = factory.make(endpoint)
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(call, endpoint, request, started + offset)
+
+    return summarise(results, time.perf_counter() - started)
+
+
+def summarise(results, elapsed):
+    summary = {}
+    for endpoint in sorted({endpoint for endpoint, _, _ in results}) + ['all']:
+        rows = [row for row in results if endpoint in ('all', row[0])]
+        latencies = np.array([latency for _, latency, _ in rows]) * 1e3
+        errors = sum(not ok for _, _, ok in rows)
+        summary[endpoint] = {
+            'requests': len(rows),
+            'errors': errors,
+            'error_rate': errors / len(rows),
+            'throughput': len(rows) / elapsed,
+            **{f'p{q}': float(np.percentile(latencies, q)) for q in (50, 90, 95, 99)},
+            'max': float(latencies.max())
+        }
+    return summary
+
+
+def check_slos(summary, slos, max_error_rate):
+    # Descriptions of every objective the summary misses
+    violations = []
+    for endpoint, objectives in slos.items():
+        if endpoint not in summary:
+            continue
+        for percentile, limit in objectives.items():
+            if summary[endpoint][percentile] > limit:
+                violations.append(f'{endpoint} {percentile} {summary[endpoint][percentile]:0.1f}ms > {limit}ms')
+
+    if summary['all']['error_rate'] > max_error_rate:
+        violations.append(f'error rate {summary["all"]["error_rate"]:0.2%} > {max_error_rate:0.2%}')
+
+    return violations
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        endpoint, weight = part.split('=')
+        mix[endpoint.strip()] = float(weight)
+    return mix
+
+
+def parse_slos(values):
+    # e.g. features.p95=200 epc.p99=400
+    slos = {}
+    for value in values:
+        name, limit = value.split('=')
+        endpoint, percentile = name.split('.')
+        slos.setdefault(endpoint, {})[percentile] = float(limit)
+    return slos
+
+
+def wait_until_ready(url, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('The server exited while starting')
+        if send(url, 'GET', '/ping', None, 1):
+            return
+        time.sleep(0.5)
+    raise RuntimeError(f'The server was not ready after {timeout}s')
+
+
+def start_server(server, port, endpoint_url, cache_dir, workers):
+    env = {
+        **os.environ,
+        'PORT': str(port),
+        'AVM_S3_ENDPOINT_URL': endpoint_url,
+        'AVM_CACHE_DIR': cache_dir,
+        'AWS_ACCESS_KEY_ID': 'load-test',
+        'AWS_SECRET_ACCESS_KEY': 'load-test'
+    }
+    if workers:
+        env['WEB_CONCURRENCY'] = str(workers)
+
+    return subprocess.Popen([sys.executable] + SERVER_COMMANDS[server], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay a request mix at fixed arrival rates against the app and check latency objectives')
+    parser.add_argument('--url', help='app to test, otherwise one is started against synthetic datasets')
+    parser.add_argument('--server', choices=list(SERVER_COMMANDS), default='gunicorn')
+    parser.add_argument('--workers', type=int, help='workers of the started app (defaults to WEB_CONCURRENCY)')
+    parser.add_argument('--port', type=int, default=3099)
+    parser.add_argument('--scale', default='small', help='scale of the synthetic datasets')
+    parser.add_argument('--data-dir', help='where the synthetic datasets are kept between runs')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='endpoint weights, e.g. features=0.6,epc=0.3,predict=0.1')
+    parser.add_argument('--rate', type=float, nargs='+', default=[20],
+                        help='requests per second, one stage per rate')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per stage')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of traffic before the first stage')
+    parser.add_argument('--arrivals', choices=['constant', 'poisson'], default='poisson')
+    parser.add_argument('--concurrency', type=int, default=64, help='most requests in flight')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds before a request counts as failed')
+    parser.add_argument('--slo', nargs='*', default=None,
+                        help='latency objectives in ms replacing the defaults, e.g. features.p95=200')
+    parser.add_argument('--max-error-rate', type=float, default=DEFAULT_MAX_ERROR_RATE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    slos = DEFAULT_SLOS if args.slo is None else parse_slos(args.slo)
+    data_dir = args.data_dir or os.path.join(
+        tempfile.gettempdir(), 'avm-benchmark', f'{args.scale}-{args.seed}')
+    ensure_datasets(data_dir, args.scale, args.seed)
+    factory = RequestFactory(data_dir, args.seed)
+
+    s3 = process = None
+    url = args.url
+    cache_dir = tempfile.TemporaryDirectory()
+
+    try:
+        if url is None:
+            s3 = S3Server(data_dir).start()
+            process = start_server(args.server, args.port, s3.endpoint_url, cache_dir.name, args.workers)
+            url = f'http://127.0.0.1:{args.port}'
+
+        wait_until_ready(url.rstrip('/'), process, timeout=600)
+        url = url.rstrip('/')
+
+        if args.warmup > 0:
+            run_at_rate(url, factory, args.mix, args.rate[0], args.warmup,
+                        args.concurrency, args.timeout, args.arrivals, args.seed)
+
+        stages = []
+        for i, rate in enumerate(args.rate):
+            summary = run_at_rate(url, factory, args.mix, rate, args.duration,
+                                  args.concurrency, args.timeout, args.arrivals, args.seed + i + 1)
+            violations = check_slos(summary, slos, args.max_error_rate)
+            stages.append({'rate': rate, 'summary': summary, 'violations': violations})
+
+            print(f'{rate:g} req/s for {args.duration:g}s: ' + ('passed' if not violations else 'FAILED'))
+            for endpoint, result in summary.items():
+                print(f'  {endpoint:12} {result["requests"]:6d} requests, {result["throughput"]:7.1f}/s, '
+                      f'p50 {result["p50"]:7.1f}ms, p95 {result["p95"]:7.1f}ms, p99 {result["p99"]:7.1f}ms, '
+                      f'errors {result["error_rate"]:0.2%}')
+            for violation in violations:
+                print(f'  SLO missed: {violation}')
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if s3 is not None:
+            s3.shutdown()
+        cache_dir.cleanup()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'url': args.url, 'server': None if args.url else args.server, 'mix': args.mix,
+                       'slos': slos, 'max_error_rate': args.max_error_rate, 'stages': stages}, f, indent=2)
+
+    sys.exit(1 if any(stage['violations'] for stage in stages) else 0)
@@ -0,0 +1,188 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import boto3
+import numpy as np
+from benchmarks.s3_server import S3Server
+from benchmarks.synthetic import SCALES, training_frame, write_datasets
+from modules.attribute_finder import LocationAttributeFinder
+from modules.data_reader import S3DataReader
+from modules.file_cache import LocalFileCache
+from modules.model import Model
+from modules.response_cache import ResponseCache
+from modules.startup_loader import StartupLoader
+
+BATCH_SIZE = 100
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def ensure_datasets(directory, scale, seed):
+    if os.path.exists(os.path.join(directory, Model.model_name)):
+        return None
+
+    # Generated in a separate process so that its memory does not count
+    # towards the peak RSS of the server
+    started = time.perf_counter()
+    process = multiprocessing.get_context('spawn').Process(
+        target=write_datasets, args=(directory, scale, seed))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'Generating the {scale} datasets failed')
+
+    return time.perf_counter() - started
+
+
+def make_reader(endpoint_url, cache_dir):
+    s3 = boto3.client('s3', endpoint_url=endpoint_url, region_name='eu-west-2',
+                      aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+    return S3DataReader(s3=s3, cache=LocalFileCache(cache_dir), offline=False, stream=False)
+
+
+def start_up(reader):
+    # The same stages the app runs at start up, with the response cache off
+    # so that every request below is computed
+    loader = StartupLoader()
+    loader.add('model', lambda _: Model(reader))
+    loader.add('finder', lambda _: LocationAttributeFinder(
+        reader, bundle_dir='', cache=ResponseCache(max_size=0), default_fields={}))
+
+    return loader.run(), dict(loader.timings)
+
+
+def measure(call, arguments, warmup=10):
+    for argument in arguments[:warmup]:
+        call(argument)
+
+    latencies = []
+    for argument in arguments:
+        started = time.perf_counter()
+        call(argument)
+        latencies.append(time.perf_counter() - started)
+
+    latencies = np.array(latencies)
+    return {
+        'calls': len(latencies),
+        'mean_ms': float(latencies.mean() * 1e3),
+        'p50_ms': float(np.percentile(latencies, 50) * 1e3),
+        'p95_ms': float(np.percentile(latencies, 95) * 1e3),
+        'p99_ms': float(np.percentile(latencies, 99) * 1e3),
+        'max_ms': float(latencies.max() * 1e3),
+        'throughput': float(len(latencies) / latencies.sum())
+    }
+
+
+def benchmark_endpoints(finder, model, requests, seed):
+    rng = np.random.default_rng(seed)
+
+    # Query at real addresses, so the points follow where people live
+    uprns = finder.uprn_index.df[['UPRN_LATITUDE', 'UPRN_LONGITUDE']].to_numpy(dtype=float)
+    points = [tuple(point) for point in uprns[rng.integers(0, len(uprns), requests)]]
+    batches = [[tuple(point) for point in uprns[rng.integers(0, len(uprns), BATCH_SIZE)]]
+               for _ in range(max(requests // 10, 10))]
+    records = [training_frame(rng, 1) for _ in range(requests)]
+    record_batches = [training_frame(rng, BATCH_SIZE) for _ in range(max(requests // 10, 10))]
+
+    calls = {
+        'epc': (lambda point: finder.find_epc(lat=point[0], lon=point[1], top_n=5), points),
+        'transports': (lambda point: finder.find_transport(lat=point[0], lon=point[1], radius=800), points),
+        'schools': (lambda point: finder.find_schools(lat=point[0], lon=point[1], radius=800), points),
+        'greenspace': (lambda point: finder.find_green_space(lat=point[0], lon=point[1], top_n=5), points),
+        'imd': (lambda point: finder.find_imd(lat=point[0], lon=point[1], top_n=5), points),
+        'features': (lambda point: finder.find_all(lat=point[0], lon=point[1], radius=804), points),
+        'features_batch': (lambda batch: finder.find_all_batch(central_points=batch, radius=804), batches),
+        'predict': (lambda record: model.predict_batch(record), records),
+        'predict_batch': (lambda batch: model.predict_batch(batch), record_batches)
+    }
+
+    results = {}
+    for name, (call, arguments) in calls.items():
+        results[name] = measure(call, arguments)
+        print(f'{name}: p50 {results[name]["p50_ms"]:0.2f}ms, p95 {results[name]["p95_ms"]:0.2f}ms, '
+              f'{results[name]["throughput"]:0.1f} calls/s')
+
+    return results
+
+
+def run(scale, data_dir, requests, seed, latency):
+    results = {
+        'commit': get_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': scale,
+        'sizes': SCALES[scale],
+        'seed': seed,
+        'requests': requests,
+        'generated_in': ensure_datasets(data_dir, scale, seed)
+    }
+
+    server = S3Server(data_dir, latency=latency).start()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Cold: nothing cached and every workbook and CSV converted. Warm:
+        # every object revalidated by ETag and read from the local cache.
+        loaded, cold = start_up(make_reader(server.endpoint_url, cache_dir))
+        results['peak_rss_after_start_up'] = get_peak_rss()
+        del loaded
+        gc.collect()
+
+        loaded, warm = start_up(make_reader(server.endpoint_url, cache_dir))
+        results['start_up'] = {'cold': cold, 'warm': warm}
+
+    server.shutdown()
+
+    finder, model = loaded['finder'], loaded['model']
+    results['rows'] = finder.get_load_status()
+    results['endpoints'] = benchmark_endpoints(finder, model, requests, seed)
+    results['peak_rss'] = get_peak_rss()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark start up and the endpoints against synthetic datasets served by a local S3 stand-in')
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--data-dir', help='where the generated datasets are kept between runs '
+                                           '(defaults to avm-benchmark/<scale>-<seed> in the system temp directory)')
+    parser.add_argument('--requests', type=int, default=500, help='calls per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every S3 request')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or os.path.join(
+        tempfile.gettempdir(), 'avm-benchmark', f'{args.scale}-{args.seed}')
+    results = run(args.scale, data_dir, args.requests, args.seed, args.latency)
+
+    mb = 1024 ** 2
+    print(f'Start up: cold {results["start_up"]["cold"]["total"]:0.2f}s, '
+          f'warm {results["start_up"]["warm"]["total"]:0.2f}s, peak RSS {results["peak_rss"] / mb:0.0f} MB')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
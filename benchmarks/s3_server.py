@@ -0,0 +1,154 @@
+import argparse
+import hashlib
+import os
+import re
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    # Serves the files of a directory as the objects of any bucket, with the
+    # parts of the S3 API the data reader uses: HEAD and GET with ETags,
+    # conditional requests and byte ranges
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.__respond(send_body=False)
+
+    def do_GET(self):
+        self.__respond(send_body=True)
+
+    def __respond(self, send_body):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        # Path style addressing, /bucket/key
+        parts = unquote(urlsplit(self.path).path).lstrip('/').split('/', 1)
+        path = self.server.resolve(parts[1]) if len(parts) == 2 else None
+
+        if path is None or not os.path.isfile(path):
+            return self.__error(404, 'NoSuchKey', send_body)
+
+        etag = self.server.get_etag(path)
+        size = os.path.getsize(path)
+
+        if self.headers.get('If-Match') not in (None, etag):
+            return self.__error(412, 'PreconditionFailed', send_body)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+
+        start, end = 0, size - 1
+        ranged = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if ranged:
+            if ranged.group(1):
+                start = int(ranged.group(1))
+                end = min(int(ranged.group(2)), end) if ranged.group(2) else end
+            else:
+                start = max(size - int(ranged.group(2)), 0)
+
+        self.send_response(206 if ranged else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Last-Modified', formatdate(os.path.getmtime(path), usegmt=True))
+        self.send_header('Accept-Ranges', 'bytes')
+        if ranged:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def __error(self, status, code, send_body):
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<Error><Code>{code}</Code><Message>{code}</Message></Error>').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body) if send_body else 0))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+class S3Server(ThreadingHTTPServer):
+    # Local stand-in for S3. Point the data reader at it with
+    # AVM_S3_ENDPOINT_URL=http://host:port and any credentials.
+    daemon_threads = True
+
+    def __init__(self, directory, host='127.0.0.1', port=0, latency=0):
+        super().__init__((host, port), S3RequestHandler)
+        self.directory = directory
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.etags = {}
+
+    def resolve(self, key):
+        # Path of the object, None for keys such as ../.. or absolute paths
+        # that lead out of the directory
+        root = os.path.realpath(self.directory)
+        path = os.path.realpath(os.path.join(root, key))
+        return path if path.startswith(root + os.sep) else None
+
+    @property
+    def endpoint_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def get_etag(self, path):
+        # MD5 of the content, as S3 reports for objects uploaded in one part,
+        # worked out again only when the file changes
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.etags.get(path)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        etag = f'"{digest.hexdigest()}"'
+        with self.lock:
+            self.etags[path] = ((stat.st_mtime_ns, stat.st_size), etag)
+        return etag
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a directory of datasets as a local S3 bucket')
+    parser.add_argument('directory', help='directory holding the objects')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    args = parser.parse_args()
+
+    server = S3Server(args.directory, host=args.host, port=args.port, latency=args.latency)
+    print(f'Serving {args.directory} at {server.endpoint_url}')
+    server.serve_forever()
@@ -0,0 +1,241 @@
+import io
+import os
+
+import joblib as jl
+import numpy as np
+import pandas as pd
+from modules.spatial_index import LONDON_BOUNDS
+from modules.transformers import DateTimeExtractor, InvalidValueCleaner, StringCleaner
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import ExtraTreesRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import OneHotEncoder
+
+# Row counts of each dataset. london is about the size of the real extracts:
+# every London UPRN and EPC certificate and the national NaPTAN and edubase
+# files, of which only a share lies within London.
+SCALES = {
+    'small': {'uprns': 40000, 'epcs': 25000, 'stops': 10000, 'schools': 2000, 'lsoas': 500},
+    'london': {'uprns': 4000000, 'epcs': 2500000, 'stops': 440000, 'schools': 50000, 'lsoas': 4835},
+    'london-10x': {'uprns': 40000000, 'epcs': 25000000, 'stops': 4400000, 'schools': 500000, 'lsoas': 48350}
+}
+
+# Addresses cluster around town centres rather than spreading evenly
+CLUSTERS = 300
+CLUSTER_SPREAD = 0.015
+
+# Inner London, where the query points of a benchmark are drawn from
+INNER_BOUNDS = ((51.35, -0.45), (51.65, 0.2))
+
+STOP_TYPES = ['BCT', 'BCS', 'BCQ', 'PLT', 'TMU', 'MET', 'RSE', 'RLY', 'TXR']
+SCHOOL_PHASES = ['Primary', 'Secondary', 'Nursery', 'All-through', 'Middle deemed primary', 'Not applicable']
+OFSTED_RATINGS = ['Outstanding', 'Good', 'Requires improvement', 'Inadequate', 'Serious Weaknesses', None]
+
+MODEL_FEATURES = ['EPC_TOTAL_FLOOR_AREA', 'EPC_PROPERTY_TYPE', 'NPT_NearbyStops', 'IMD_IMDDecile', 'PPD_TransferDate']
+
+
+def codes(prefix, values, width):
+    return np.char.add(prefix, np.char.zfill(np.asarray(values).astype(str), width))
+
+
+def clustered_points(rng, n, bounds=INNER_BOUNDS):
+    (south, west), (north, east) = bounds
+    centres = np.column_stack([rng.uniform(south, north, CLUSTERS), rng.uniform(west, east, CLUSTERS)])
+    points = centres[rng.integers(0, CLUSTERS, n)] + rng.normal(0, CLUSTER_SPREAD, (n, 2))
+    return np.clip(points, [south, west], [north, east])
+
+
+def make_onsud(rng, sizes):
+    n = sizes['uprns']
+    lsoas = codes('E0100', np.arange(sizes['lsoas']), 4)
+    msoas = codes('E0200', np.arange(sizes['lsoas'] // 5 + 1), 4)
+
+    # Blocks of flats share one coordinate
+    coordinates = clustered_points(rng, max(n // 3, 1))[rng.integers(0, max(n // 3, 1), n)]
+    lsoa_ids = rng.integers(0, len(lsoas), n)
+
+    return pd.DataFrame({
+        'CPO_BOROUGH': rng.choice(['Camden', 'Hackney', 'Islington', 'Lambeth', 'Southwark'], n),
+        'CPO_WARD': codes('W', rng.integers(0, 600, n), 3),
+        'CPO_OA': codes('E00', rng.integers(0, sizes['lsoas'] * 5, n), 6),
+        'CPO_MSOA': msoas[lsoa_ids // 5],
+        'CPO_LSOA': lsoas[lsoa_ids],
+        'UPRN_LATITUDE': coordinates[:, 0],
+        'UPRN_LONGITUDE': coordinates[:, 1]
+    }, index=pd.Index(np.arange(100000, 100000 + n), name='UPRN'))
+
+
+def make_epc(rng, sizes, uprns):
+    n = sizes['epcs']
+    # A few certificates have no UPRN
+    uprn = rng.choice(uprns, n).astype(float)
+    uprn[rng.random(n) < 0.01] = np.nan
+
+    return pd.DataFrame({
+        'EPC_UPRN': uprn,
+        'EPC_INSPECTION_DATE': pd.Timestamp('2010-01-01') + pd.to_timedelta(rng.integers(0, 4000, n), unit='D'),
+        'EPC_TOTAL_FLOOR_AREA': rng.uniform(20, 300, n).round(1),
+        'EPC_PROPERTY_TYPE': rng.choice(['House', 'Flat', 'Maisonette', 'Bungalow'], n),
+        'EPC_CURRENT_ENERGY_RATING': rng.choice(list('ABCDEFG'), n),
+        'EPC_NUMBER_HABITABLE_ROOMS': rng.integers(1, 8, n).astype(float)
+    })
+
+
+def make_naptan(rng, sizes):
+    n = sizes['stops']
+    (south, west), (north, east) = LONDON_BOUNDS
+
+    # A fifth of the national stops are in London
+    coordinates = np.column_stack([rng.uniform(50.0, 55.5, n), rng.uniform(-5.0, 1.7, n)])
+    london = rng.random(n) < 0.2
+    coordinates[london] = clustered_points(rng, london.sum(), ((south, west), (north, east)))
+
+    filler = np.full(n, 'x', dtype=object)
+    return pd.DataFrame({
+        'ATCOCode': codes('490', np.arange(n), 7),
+        'NaptanCode': filler,
+        'CommonName': codes('Stop ', np.arange(n), 1),
+        'ShortCommonName': filler,
+        'Landmark': filler,
+        'Street': filler,
+        'Indicator': rng.choice(['Stop A', 'Stop B', 'opp', 'adj'], n),
+        'Bearing': rng.choice(['N', 'E', 'S', 'W'], n),
+        'LocalityName': filler,
+        'ParentLocalityName': filler,
+        'Town': filler,
+        'Suburb': filler,
+        'LocalityCentre': 0,
+        'Easting': 530000,
+        'Northing': 180000,
+        'StopType': rng.choice(STOP_TYPES, n),
+        'BusStopType': rng.choice(['MKD', 'CUS', None], n),
+        'CreationDateTime': '2020-01-01T00:00:00',
+        'ModificationDateTime': '2021-01-01T00:00:00',
+        'RevisionNumber': 1,
+        'Modification': 'new',
+        'Status': rng.choice(['active', 'active', 'active', 'inactive'], n),
+        'ETRS89GD-Lat': coordinates[:, 0],
+        'ETRS89GD-Long': coordinates[:, 1]
+    })
+
+
+def make_edubase(rng, sizes, uprns):
+    n = sizes['schools']
+
+    # A tenth of the national schools are in London, the rest have UPRNs the
+    # ONS directory of London does not hold
+    uprn = rng.integers(1, 100000, n).astype(float)
+    london = rng.random(n) < 0.1
+    uprn[london] = rng.choice(uprns, london.sum())
+
+    return pd.DataFrame({
+        'URN': np.arange(100000, 100000 + n),
+        'EstablishmentName': codes('School ', np.arange(n), 1),
+        'TypeOfEstablishment (name)': rng.choice(['Academy converter', 'Community school', 'Other independent school'], n),
+        'EstablishmentTypeGroup (name)': rng.choice(
+            ['Academies', 'Independent schools', 'Local authority maintained schools'], n),
+        'EstablishmentStatus (name)': rng.choice(['Open', 'Open', 'Open', 'Closed'], n),
+        'PhaseOfEducation (name)': rng.choice(SCHOOL_PHASES, n),
+        'Boarders (name)': 'No boarders',
+        'NurseryProvision (name)': rng.choice(['Has Nursery Classes', 'No Nursery Classes'], n),
+        'Gender (name)': rng.choice(['Mixed', 'Girls', 'Boys'], n),
+        'ReligiousCharacter (name)': rng.choice(['None', 'Church of England', 'Roman Catholic'], n),
+        'NumberOfPupils': rng.integers(50, 1500, n).astype(float),
+        'OfstedRating (name)': rng.choice(OFSTED_RATINGS, n),
+        'HeadTitle (name)': 'Ms',
+        'HeadFirstName': 'A',
+        'HeadLastName': 'B',
+        'HeadPreferredJobTitle': 'Headteacher',
+        'Easting': 530000.0,
+        'Northing': 180000.0,
+        'UPRN': uprn
+    })
+
+
+def make_workbook(rng, sheet_index, header, columns, keys, deciles=()):
+    # A workbook whose sheet sheet_index holds the given key columns, deciles
+    # in the decile columns and percentages elsewhere, below header rows of
+    # padding
+    rows = len(next(iter(keys.values())))
+    df = pd.DataFrame({f'Column{i}': keys[i] if i in keys else rng.integers(1, 11, rows) if i in deciles else
+                       rng.uniform(0, 100, rows).round(2) for i in range(columns)})
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        for i in range(sheet_index):
+            pd.DataFrame({'Notes': ['See the data sheet']}).to_excel(writer, sheet_name=f'Notes {i}', index=False)
+        df.to_excel(writer, sheet_name='Data', index=False, startrow=header)
+
+    return buffer.getvalue()
+
+
+def training_frame(rng, n):
+    return pd.DataFrame({
+        'EPC_TOTAL_FLOOR_AREA': rng.uniform(20, 300, n),
+        'EPC_PROPERTY_TYPE': rng.choice(['House', 'Flat ', 'NO DATA!', 'maisonette'], n),
+        'NPT_NearbyStops': rng.integers(0, 50, n),
+        'IMD_IMDDecile': rng.integers(1, 11, n),
+        'PPD_TransferDate': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 2000, n), unit='D')
+    })
+
+
+def train_model(rng, samples=2000, n_estimators=100, max_depth=12):
+    # A small pipeline of the same shape as the production model: the cleaning
+    # transformers of modules.transformers, then an ExtraTreesRegressor
+    X = training_frame(rng, samples)
+    y = X['EPC_TOTAL_FLOOR_AREA'] * 5000 + X['IMD_IMDDecile'] * 10000 + rng.normal(0, 20000, samples)
+
+    columns = ColumnTransformer([
+        ('numeric', SimpleImputer(), ['EPC_TOTAL_FLOOR_AREA', 'NPT_NearbyStops', 'IMD_IMDDecile']),
+        ('categorical', make_pipeline(SimpleImputer(strategy='most_frequent'),
+                                      OneHotEncoder(handle_unknown='ignore')), ['EPC_PROPERTY_TYPE']),
+        ('dates', DateTimeExtractor(), ['PPD_TransferDate'])
+    ])
+    model = make_pipeline(make_pipeline(InvalidValueCleaner(), StringCleaner(), columns),
+                          ExtraTreesRegressor(n_estimators=n_estimators, max_depth=max_depth, random_state=0))
+    model.fit(X, y)
+
+    buffer = io.BytesIO()
+    jl.dump(model, buffer)
+    return buffer.getvalue()
+
+
+def make_datasets(scale='small', seed=0):
+    # Every object the server reads from S3, keyed by its S3 key
+    sizes = SCALES[scale]
+    rng = np.random.default_rng(seed)
+    objects = {}
+
+    onsud = make_onsud(rng, sizes)
+    buffer = io.BytesIO()
+    onsud.to_parquet(buffer)
+    objects['london_onsud_uprn.parquet'] = buffer.getvalue()
+
+    buffer = io.BytesIO()
+    make_epc(rng, sizes, onsud.index.to_numpy()).to_parquet(buffer)
+    objects['london_epc.parquet'] = buffer.getvalue()
+
+    objects['NaPTAN_stops_geodetic.csv'] = make_naptan(rng, sizes).to_csv(index=False).encode('utf-8')
+    objects['national_school_edubasealldata20230402.csv'] = make_edubase(
+        rng, sizes, onsud.index.to_numpy()).to_csv(index=False).encode('ISO-8859-1')
+
+    lsoas = np.unique(onsud['CPO_LSOA'].to_numpy())
+    msoas = np.unique(onsud['CPO_MSOA'].to_numpy())
+    objects['osprivateoutdoorspacereferencetables.xlsx'] = make_workbook(
+        rng, 4, 1, 21, {6: msoas, 7: np.char.add('MSOA ', msoas)})
+    objects['ospublicgreenspacereferencetables.xlsx'] = make_workbook(
+        rng, 7, 0, 16, {8: lsoas, 9: np.char.add('LSOA ', lsoas)})
+    objects['File_2_-_IoD2019_Domains_of_Deprivation.xlsx'] = make_workbook(
+        rng, 1, 1, 18, {0: lsoas, 1: np.char.add('LSOA ', lsoas)}, deciles=range(2, 18))
+
+    objects['model.joblib'] = train_model(rng)
+
+    return objects
+
+
+def write_datasets(directory, scale='small', seed=0):
+    os.makedirs(directory, exist_ok=True)
+    for key, content in make_datasets(scale, seed).items():
+        with open(os.path.join(directory, key), 'wb') as f:
+            f.write(content)
@@ -0,0 +1,22 @@
+import gc
+import os
+
+bind = f'0.0.0.0:{os.environ.get("PORT", 3001)}'
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+
+# The model reads WEB_CONCURRENCY to share the cores between the workers
+os.environ.setdefault('WEB_CONCURRENCY', str(workers))
+
+# Load the datasets, trees and model once in the master and fork the workers
+# from it, so they share its pages instead of each building their own copy
+preload_app = os.environ.get('AVM_PRELOAD', '1').lower() in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    # Called once the app is loaded and before any worker is forked. Frozen
+    # objects are never scanned by the collector again, so the workers do not
+    # write to, and thereby copy, the pages holding them.
+    if preload_app:
+        gc.collect()
+        gc.freeze()
+        server.log.info(f'Froze {gc.get_freeze_count()} objects before forking')
@@ -1,28 +1,137 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import modules.bundle as bundle
 import modules.utils as utils
 import pandas as pd
 from modules.data_reader import S3DataReader
 from modules.epc_finder import EPCFinder
+from modules.generation import GenerationManager
 from modules.greenspace_finder import GreenSpaceFinder
 from modules.imd_finder import IMDFinder
+from modules.response_cache import ResponseCache
+from modules.serializer import JSON_MIMETYPE, serializer
 from modules.school_finder import SchoolFinder
+from modules.startup_loader import StartupLoader
 from modules.transport_finder import TransportFinder
+from modules.uprn_index import UPRNIndex
+
+
+class InvalidFieldsError(ValueError):
+    pass
 
 
 class LocationAttributeFinder:
-    def __init__(self):
-        self.reader = S3DataReader()
+    endpoints = ('epc', 'transports', 'schools', 'greenspace', 'imd', 'features')
+
+    # Objects read from S3 by the finders
+    datasets = ('london_onsud_uprn.parquet', 'london_epc.parquet', 'NaPTAN_stops_geodetic.csv',
+                'national_school_edubasealldata20230402.csv', 'osprivateoutdoorspacereferencetables.xlsx',
+                'ospublicgreenspacereferencetables.xlsx', 'File_2_-_IoD2019_Domains_of_Deprivation.xlsx')
+
+    # Per process state that is never written into a bundle
+    bundle_exclude = ('bundle_dir', 'cache', 'default_fields', 'version',
+                      'fan_out_threads', 'executor', 'executor_lock')
+
+    def __init__(self, reader=None, bundle_dir=None, cache=None, default_fields=None, version=None,
+                 fan_out_threads=None):
+        self.reader = reader or S3DataReader()
+        # Identifies the datasets behind the cached responses, so that a
+        # cache shared with other generations never mixes their responses
+        self.version = version
+
+        # Threads the lookups behind /features are spread over, 0 or 1 runs
+        # them one after another. The pool is created on first use.
+        self.fan_out_threads = int(os.environ.get(
+            'AVM_FAN_OUT_THREADS', 3)) if fan_out_threads is None else fan_out_threads
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.bundle_dir = os.environ.get(
+            'AVM_BUNDLE_DIR') if bundle_dir is None else bundle_dir
+        self.cache = cache or ResponseCache.from_env()
+
+        # Default projection per endpoint, e.g. AVM_DEFAULT_FIELDS_SCHOOLS=SCH_NAME,SCH_PHASE
+        self.default_fields = default_fields if default_fields is not None else {
+            endpoint: utils.split_fields(os.environ[f'AVM_DEFAULT_FIELDS_{endpoint.upper()}'])
+            for endpoint in LocationAttributeFinder.endpoints if f'AVM_DEFAULT_FIELDS_{endpoint.upper()}' in os.environ
+        }
+
+        self.__load()
+
+        # Fail at start up rather than on the first request
+        for endpoint in self.default_fields:
+            self.resolve_fields(endpoint)
+
+    def __load(self):
+        # Open the precompiled bundle when there is one, otherwise build every
+        # finder from the raw datasets. Only ever run on a new finder: a
+        # reload builds a whole new generation (see modules.generation).
+        etags = self.__get_bundle_etags()
+        if etags is not None:
+            loaded = bundle.read_bundle(self.bundle_dir, self.reader)
+            vars(self).update(vars(loaded))
+            # Labelled with the datasets the bundle was built from rather
+            # than with what S3 holds now
+            if self.version is not None:
+                self.version = GenerationManager.get_version(etags)
+        else:
+            self.__load_datasets()
+
+        # Cached responses were computed from the previous datasets, unless
+        # they are told apart by version
+        if self.version is None:
+            self.cache.invalidate()
+
+    def __get_bundle_etags(self):
+        # ETags of the datasets behind the bundle, or None when there is no
+        # bundle to open. A bundle built from other versions of the datasets
+        # than S3 holds is refused, unless S3 cannot tell.
+        if not self.bundle_dir or not bundle.is_bundle(self.bundle_dir):
+            return None
+
+        etags = bundle.get_etags(self.bundle_dir)
+        current = self.reader.get_etags(LocationAttributeFinder.datasets)
+        stale = [key for key, etag in current.items() if etag is not None and etag != etags.get(key)]
+        if stale:
+            print(f'Bundle {self.bundle_dir} is stale ({", ".join(stale)} changed), '
+                  f'building from the raw datasets')
+            return None
+
+        return etags
+
+    def __load_datasets(self):
+        loader = StartupLoader()
+
+        # EPC, schools, green space and IMD all need the ONS UPRN directory
+        loader.add('onsud', lambda _: self.reader.load_file(
+            'london_onsud_uprn', 'parquet'))
+        loader.add('uprn_index', lambda r: UPRNIndex(r['onsud']), ['onsud'])
+        loader.add('epc_finder', lambda r: EPCFinder(
+            self.reader, r['onsud']), ['onsud'])
+        loader.add('transport_finder', lambda _: TransportFinder(self.reader))
+        loader.add('school_finder', lambda r: SchoolFinder(
+            self.reader, r['onsud']), ['onsud'])
+        loader.add('space_finder', lambda r: GreenSpaceFinder(
+            self.reader, r['uprn_index']), ['uprn_index'])
+        loader.add('imd_finder', lambda r: IMDFinder(
+            self.reader, r['uprn_index']), ['uprn_index'])
 
         with utils.Timer() as t:
             t.log(f'Initialising attribute finders')
 
-            onsud_uprn_df = self.reader.load_file(
-                'london_onsud_uprn', 'parquet')
+            # Every download starts straight away, so that each dataset is
+            # parsed while the ones after it are still downloading
+            try:
+                results = loader.run(prefetch=lambda executor: self.reader.prefetch(
+                    LocationAttributeFinder.datasets, executor))
+            finally:
+                self.reader.discard_prefetched()
 
-            self.epc_finder = EPCFinder(self.reader, onsud_uprn_df)
-            self.transport_finder = TransportFinder(self.reader)
-            self.school_finder = SchoolFinder(self.reader, onsud_uprn_df)
-            self.space_finder = GreenSpaceFinder(self.reader, onsud_uprn_df)
-            self.imd_finder = IMDFinder(self.reader, onsud_uprn_df)
+            for name in ('uprn_index', 'epc_finder', 'transport_finder',
+                         'school_finder', 'space_finder', 'imd_finder'):
+                setattr(self, name, results[name])
 
             t.log(f'All attribute finders initialised!')
 
@@ -31,41 +140,143 @@ class LocationAttributeFinder:
             'epc': len(self.epc_finder.df),
             'transport': len(self.transport_finder.df),
             'schools': len(self.school_finder.df),
-            'green_space': len(self.space_finder.df),
-            'imd': len(self.imd_finder.df)
+            'green_space': len(self.uprn_index.df),
+            'imd': len(self.uprn_index.df),
+            'memory': {
+                'epc': self.epc_finder.memory_usage,
+                'transport': self.transport_finder.memory_usage,
+                'schools': self.school_finder.memory_usage,
+                'uprn_index': self.uprn_index.memory_usage
+            },
+            'response_cache': self.cache.get_stats()
         }
 
-    def find_epc(self, lat, lon, top_n):
-        return self.epc_finder.get_closest_matches(central_point=(lat, lon), top_n=top_n).to_json(orient='records')
+    def get_fields(self, endpoint):
+        if endpoint == 'epc':
+            return self.epc_finder.get_fields()
+        if endpoint == 'transports':
+            return self.transport_finder.get_fields()
+        if endpoint == 'schools':
+            return self.school_finder.get_fields()
+        if endpoint == 'greenspace':
+            return self.space_finder.get_fields()
+        if endpoint == 'imd':
+            return self.imd_finder.get_fields()
+        if endpoint == 'features':
+            fields = (self.transport_finder.get_count_fields() + self.school_finder.get_count_fields() +
+                      self.space_finder.get_fields() + self.imd_finder.get_fields())
+            return [field for field, duplicated in zip(fields, pd.Index(fields).duplicated(keep='last')) if not duplicated]
+
+        raise ValueError(f'Unknown endpoint: {endpoint}')
+
+    def resolve_fields(self, endpoint, fields=None):
+        # The columns to return in schema order, or None for every column.
+        # An empty list, e.g. from fields=, counts as no projection at all.
+        if not fields:
+            fields = self.default_fields.get(endpoint)
+            if not fields:
+                return None
+
+        schema = self.get_fields(endpoint)
+
+        unknown = [field for field in fields if field not in schema]
+        if unknown:
+            raise InvalidFieldsError(f'Unknown fields: {", ".join(unknown)}')
+
+        return tuple(field for field in schema if field in fields)
+
+    def __cached(self, endpoint, lat, lon, params, compute):
+        # Responses are computed from the snapped coordinates so that every
+        # request falling into the same snapped location gets the same answer
+        lat, lon = self.cache.snap(lat, lon)
+        return self.cache.get_or_compute((endpoint, self.version, lat, lon) + params, lambda: compute(lat, lon))
+
+    def find_epc(self, lat, lon, top_n, fields=None, mimetype=JSON_MIMETYPE):
+        columns = self.resolve_fields('epc', fields)
+        return self.__cached('epc', lat, lon, (top_n, columns, mimetype), lambda lat, lon: serializer.serialize(
+            self.epc_finder.get_closest_matches(central_point=(lat, lon), top_n=top_n, columns=columns), mimetype))
+
+    def find_transport(self, lat, lon, radius, fields=None, mimetype=JSON_MIMETYPE):
+        columns = self.resolve_fields('transports', fields)
+        return self.__cached('transports', lat, lon, (radius, columns, mimetype), lambda lat, lon: serializer.serialize(
+            self.transport_finder.get_stops_within_radius(central_point=(lat, lon), radius=radius, columns=columns), mimetype))
+
+    def find_schools(self, lat, lon, radius, fields=None, mimetype=JSON_MIMETYPE):
+        columns = self.resolve_fields('schools', fields)
+        return self.__cached('schools', lat, lon, (radius, columns, mimetype), lambda lat, lon: serializer.serialize(
+            self.school_finder.get_schools_within_radius(central_point=(lat, lon), radius=radius, columns=columns), mimetype))
+
+    def find_green_space(self, lat, lon, top_n, fields=None, mimetype=JSON_MIMETYPE):
+        columns = self.resolve_fields('greenspace', fields)
+        return self.__cached('greenspace', lat, lon, (top_n, columns, mimetype), lambda lat, lon: serializer.serialize(
+            self.space_finder.get_closest_matches(central_point=(lat, lon), top_n=top_n, columns=columns), mimetype))
+
+    def find_imd(self, lat, lon, top_n, fields=None, mimetype=JSON_MIMETYPE):
+        columns = self.resolve_fields('imd', fields)
+        return self.__cached('imd', lat, lon, (top_n, columns, mimetype), lambda lat, lon: serializer.serialize(
+            self.imd_finder.get_closest_matches(central_point=(lat, lon), top_n=top_n, columns=columns), mimetype))
+
+    def find_all(self, lat, lon, radius, fields=None, mimetype=JSON_MIMETYPE):
+        columns = self.resolve_fields('features', fields)
+        return self.__cached('features', lat, lon, (radius, columns, mimetype), lambda lat, lon: self.find_all_batch(
+            central_points=[(lat, lon)], radius=radius, fields=columns, mimetype=mimetype))
+
+    def find_all_batch(self, central_points, radius, fields=None, mimetype=JSON_MIMETYPE):
+        columns = self.resolve_fields('features', fields)
+
+        # The tree queries release the GIL, so the three lookups run
+        # concurrently
+        transport, school, (green_space, imd) = self.__gather(
+            lambda: self.transport_finder.get_stop_counts_batch(
+                central_points=central_points, radius=radius),
+            lambda: self.school_finder.get_school_counts_batch(
+                central_points=central_points, radius=radius),
+            lambda: self.__resolve_nearest_uprn(central_points, columns))
+
+        with utils.Timer('merge'):
+            df = pd.concat([
+                transport.reset_index(drop=True),
+                school.reset_index(drop=True),
+                green_space.reset_index(drop=True),
+                imd.reset_index(drop=True)
+            ], axis=1)
+            df = df.loc[:, ~df.columns.duplicated(keep='last')]  # type: ignore
+
+            if columns is not None:
+                df = df[list(columns)]
+
+        return serializer.serialize(df, mimetype)
+
+    def __resolve_nearest_uprn(self, central_points, columns):
+        # Green space and IMD are both resolved from the same nearest UPRN
+        nearest_uprn = self.uprn_index.get_nearest_matches(central_points)
 
-    def find_transport(self, lat, lon, radius):
-        return self.transport_finder.get_stops_within_radius(central_point=(lat, lon), radius=radius).to_json(orient='records')
+        with utils.Timer('merge'):
+            green_space = self.space_finder.resolve(
+                nearest_uprn, LocationAttributeFinder.__project(self.space_finder.get_fields(), columns))
+            imd = self.imd_finder.resolve(
+                nearest_uprn, LocationAttributeFinder.__project(self.imd_finder.get_fields(), columns))
 
-    def find_schools(self, lat, lon, radius):
-        return self.school_finder.get_schools_within_radius(central_point=(lat, lon), radius=radius).to_json(orient='records')
+        return green_space, imd
 
-    def find_green_space(self, lat, lon, top_n):
-        return self.space_finder.get_closest_matches(central_point=(lat, lon), top_n=top_n).to_json(orient='records')
+    def __gather(self, *calls):
+        # Results of the calls in order. All but the last run on the pool
+        # while the calling thread runs the last one itself.
+        if self.fan_out_threads <= 1:
+            return [call() for call in calls]
 
-    def find_imd(self, lat, lon, top_n):
-        return self.imd_finder.get_closest_matches(central_point=(lat, lon), top_n=top_n).to_json(orient='records')
+        if self.executor is None:
+            with self.executor_lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.fan_out_threads, thread_name_prefix='fan-out')
 
-    def find_all(self, lat, lon, radius):
-        transport = self.transport_finder.get_stop_counts(
-            central_point=(lat, lon), radius=radius)
-        school = self.school_finder.get_school_counts(
-            central_point=(lat, lon), radius=radius)
-        green_space = self.space_finder.get_closest_matches(
-            central_point=(lat, lon), top_n=1)
-        imd = self.imd_finder.get_closest_matches(
-            central_point=(lat, lon), top_n=1)
+        # Each call runs in a copy of the request context, e.g. its endpoint
+        futures = [self.executor.submit(contextvars.copy_context().run, call) for call in calls[:-1]]
+        last = calls[-1]()
 
-        df = pd.concat([
-            transport.reset_index(drop=True),
-            school.reset_index(drop=True),
-            green_space.reset_index(drop=True),
-            imd.reset_index(drop=True)
-        ], axis=1)
-        df = df.loc[:, ~df.columns.duplicated(keep='last')]  # type: ignore
+        return [future.result() for future in futures] + [last]
 
-        return df.to_json(orient='records')
+    @staticmethod
+    def __project(fields, columns):
+        return None if columns is None else [field for field in fields if field in columns]
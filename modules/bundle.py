@@ -0,0 +1,233 @@
+import argparse
+import importlib
+import json
+import os
+import pickle
+import shutil
+import time
+
+import modules.utils as utils
+import numpy as np
+import pandas as pd
+from modules.data_reader import S3DataReader
+
+# Bump whenever the attributes held by the finders change shape so that stale
+# bundles are rebuilt instead of being loaded into incompatible objects
+BUNDLE_VERSION = 8
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class BundleWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        self.counter = 0
+        self.written = {}
+
+    def __next_path(self, suffix=''):
+        self.counter += 1
+        return f'{self.counter:04d}{suffix}'
+
+    def write(self, value):
+        # Objects shared between finders are written once and referenced after
+        if id(value) in self.written:
+            return {'kind': 'ref', 'path': self.written[id(value)]}
+
+        if isinstance(value, S3DataReader):
+            spec = {'kind': 'reader'}
+        elif isinstance(value, pd.DataFrame):
+            spec = self.__write_frame(value)
+        elif isinstance(value, np.ndarray) and value.dtype != object:
+            spec = self.__write_array(value)
+        elif type(value).__module__.startswith('modules.') and hasattr(value, '__dict__'):
+            spec = {
+                'kind': 'object',
+                'path': self.__next_path(),
+                'class': f'{type(value).__module__}.{type(value).__qualname__}'
+            }
+            self.written[id(value)] = spec['path']
+            exclude = getattr(type(value), 'bundle_exclude', ())
+            spec['attrs'] = {name: self.write(attr)
+                             for name, attr in vars(value).items() if name not in exclude}
+        else:
+            spec = self.__write_pickle(value)
+
+        if 'path' in spec:
+            self.written[id(value)] = spec['path']
+
+        return spec
+
+    def __write_array(self, values):
+        path = self.__next_path('.npy')
+        np.save(os.path.join(self.directory, path), np.ascontiguousarray(values))
+        return {'kind': 'array', 'path': path}
+
+    def __write_pickle(self, value):
+        path = self.__next_path('.pkl')
+        with open(os.path.join(self.directory, path), 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return {'kind': 'pickle', 'path': path}
+
+    def __write_series(self, series):
+        dtype = series.dtype
+
+        if isinstance(dtype, pd.CategoricalDtype):
+            return {
+                'kind': 'categorical',
+                'codes': self.__write_array(series.cat.codes.to_numpy()),
+                'categories': self.__write_pickle(dtype.categories),
+                'ordered': bool(dtype.ordered)
+            }
+
+        # Plain numpy columns (numbers, booleans, naive datetimes) can be memory
+        # mapped, everything else is pickled and loaded into private memory
+        if isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM':
+            return self.__write_array(series.to_numpy())
+
+        return self.__write_pickle(series)
+
+    def __write_frame(self, df):
+        if isinstance(df.index, pd.RangeIndex):
+            index = {'kind': 'range', 'start': df.index.start,
+                     'stop': df.index.stop, 'step': df.index.step, 'name': df.index.name}
+        else:
+            index = self.__write_pickle(df.index)
+
+        path = self.__next_path()
+
+        return {
+            'kind': 'frame',
+            'path': path,
+            'index': index,
+            'columns': [[name, self.__write_series(df[name])] for name in df.columns]
+        }
+
+
+class BundleReader:
+    def __init__(self, directory, reader=None):
+        self.directory = directory
+        self.reader = reader
+        self.loaded = {}
+
+    def read(self, spec):
+        kind = spec['kind']
+
+        if kind == 'ref':
+            return self.loaded[spec['path']]
+        if kind == 'reader':
+            return self.reader
+
+        if kind == 'object':
+            module_name, class_name = spec['class'].rsplit('.', 1)
+            cls = getattr(importlib.import_module(module_name), class_name)
+            value = cls.__new__(cls)
+            self.loaded[spec['path']] = value
+            state = {name: self.read(attr) for name, attr in spec['attrs'].items()}
+            # Classes that rebuild their excluded attributes do so on load
+            if hasattr(cls, '__setstate__'):
+                value.__setstate__(state)
+            else:
+                vars(value).update(state)
+            return value
+
+        if kind == 'array':
+            value = np.load(os.path.join(self.directory, spec['path']), mmap_mode='r')
+        elif kind == 'pickle':
+            with open(os.path.join(self.directory, spec['path']), 'rb') as f:
+                value = pickle.load(f)
+        elif kind == 'frame':
+            value = self.__read_frame(spec)
+        else:
+            raise ValueError(f'Unsupported bundle entry: {kind}')
+
+        self.loaded[spec['path']] = value
+        return value
+
+    def __read_series(self, spec):
+        if spec['kind'] == 'categorical':
+            dtype = pd.CategoricalDtype(self.read(spec['categories']), ordered=spec['ordered'])
+            return pd.Categorical.from_codes(self.read(spec['codes']), dtype=dtype)
+
+        value = self.read(spec)
+        return value.array if isinstance(value, pd.Series) else value
+
+    def __read_frame(self, spec):
+        index = spec['index']
+        if index['kind'] == 'range':
+            index = pd.RangeIndex(index['start'], index['stop'], index['step'], name=index['name'])
+        else:
+            index = self.read(index)
+
+        # copy=False keeps every column backed by its own memory mapped array
+        columns = {name: self.__read_series(column) for name, column in spec['columns']}
+        return pd.DataFrame(columns, index=index, copy=False)
+
+
+def is_bundle(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), 'r') as f:
+            return json.load(f).get('version') == BUNDLE_VERSION
+    except (OSError, ValueError):
+        return False
+
+
+def get_etags(directory):
+    # ETags of the datasets the bundle was built from
+    with open(os.path.join(directory, MANIFEST_NAME), 'r') as f:
+        return json.load(f).get('etags') or {}
+
+
+def write_bundle(directory, obj, etags=None):
+    with utils.Timer() as t:
+        t.log(f'Writing bundle to {directory}')
+
+        # Build into a sibling directory and swap it in so a running server
+        # never sees a half written bundle
+        staging = directory.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        root = BundleWriter(staging).write(obj)
+        with open(os.path.join(staging, MANIFEST_NAME), 'w') as f:
+            json.dump({'version': BUNDLE_VERSION, 'created': time.time(), 'etags': etags or {}, 'root': root}, f)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(staging, directory)
+
+        t.log(f'Bundle written to {directory}')
+
+
+def read_bundle(directory, reader=None):
+    with utils.Timer() as t:
+        t.log(f'Opening bundle {directory}')
+
+        with open(os.path.join(directory, MANIFEST_NAME), 'r') as f:
+            manifest = json.load(f)
+
+        if manifest.get('version') != BUNDLE_VERSION:
+            raise ValueError(
+                f"Bundle version {manifest.get('version')} does not match {BUNDLE_VERSION}")
+
+        obj = BundleReader(directory, reader).read(manifest['root'])
+        t.log(f'Bundle opened')
+
+    return obj
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from modules.attribute_finder import LocationAttributeFinder
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description='Build the precompiled finder bundle from the raw datasets')
+    parser.add_argument('directory', nargs='?', default=os.environ.get('AVM_BUNDLE_DIR', 'bundle'),
+                        help='output directory (defaults to $AVM_BUNDLE_DIR or ./bundle)')
+    args = parser.parse_args()
+
+    # Read before building, so that a dataset replaced during the build makes
+    # the bundle look stale rather than current
+    reader = S3DataReader()
+    etags = reader.get_etags(LocationAttributeFinder.datasets)
+    write_bundle(args.directory, LocationAttributeFinder(reader, bundle_dir=''), etags)
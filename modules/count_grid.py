@@ -0,0 +1,223 @@
+import argparse
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import modules.utils as utils
+import numpy as np
+from modules.spatial_index import EARTH_RADIUS, LONDON_BOUNDS, SpatialIndex
+
+# Stencils kept for the most recently queried radii
+MAX_STENCILS = 32
+
+
+class CountGrid:
+    # Per cell counts of each mask column over a grid of square cells laid on
+    # a local equirectangular projection, summed along each row of cells.
+    # The cells wholly inside a search circle are counted from the row sums
+    # and only the points in the cells the circle boundary crosses are
+    # checked exactly, so counts match a radius query on the spatial index.
+    # Stencils are built again on demand, so they are left out of bundles
+    bundle_exclude = ('stencils', 'stencils_lock')
+
+    def __init__(self, index, masks, cell_size=100, bounds=LONDON_BOUNDS):
+        coordinates = index.get_coordinates()
+        self.index = index
+        self.masks = masks
+        self.cell_size = float(cell_size)
+
+        # Grid over the points within bounds only; queries reaching beyond it
+        # are answered by the spatial index
+        (south, west), (north, east) = bounds
+        inside = ((coordinates[:, 0] >= south) & (coordinates[:, 0] <= north) &
+                  (coordinates[:, 1] >= west) & (coordinates[:, 1] <= east))
+        rows = np.flatnonzero(inside)
+
+        if len(rows):
+            south, west = coordinates[rows].min(axis=0)
+            north, east = coordinates[rows].max(axis=0)
+
+        self.origin = np.array([south, west])
+        self.lon_scale = np.cos(np.radians((south + north) / 2))
+
+        # Largest relative difference between projected and great circle
+        # distances within the grid, with a margin for rounding
+        self.tolerance = np.max(np.abs(
+            np.cos(np.radians([south, north])) / self.lon_scale - 1)) + 1e-4
+
+        extent = self.__project(np.array([[north, east]]))[0]
+        self.shape = (np.floor(extent / self.cell_size).astype(np.intp) + 1)[::-1]
+
+        cells = self.__cells(coordinates[rows])
+        cell_ids = cells[:, 1] * self.shape[1] + cells[:, 0]
+        order = np.argsort(cell_ids, kind='stable')
+
+        self.rows = rows[order]
+        self.points = index.tree.data[self.rows]
+        self.cell_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(cell_ids, minlength=self.shape[0] * self.shape[1]))])
+
+        # prefix[c, y, x] counts the points flagged in column c (the last
+        # column counts every point) in the cells of row y left of x
+        flags = np.column_stack([masks[self.rows], np.ones(len(self.rows), dtype=bool)])
+        prefix = np.zeros((flags.shape[1], self.shape[0], self.shape[1] + 1),
+                          dtype=np.min_scalar_type(len(self.rows)))
+        for column in range(flags.shape[1]):
+            prefix[column, :, 1:] = np.cumsum(np.bincount(
+                cell_ids[order][flags[:, column]], minlength=self.shape[0] * self.shape[1]).reshape(self.shape), axis=1)
+        self.prefix = prefix
+        self.__reset_stencils()
+
+    def __getstate__(self):
+        return {name: value for name, value in vars(self).items() if name not in CountGrid.bundle_exclude}
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self.__reset_stencils()
+
+    def __reset_stencils(self):
+        self.stencils = OrderedDict()
+        self.stencils_lock = threading.Lock()
+
+    @staticmethod
+    def from_env(index, masks):
+        # AVM_COUNT_GRID_CELL is the cell size in metres, the grid is off
+        # unless it is set
+        cell_size = float(os.environ.get('AVM_COUNT_GRID_CELL', 0))
+        return CountGrid(index, masks, cell_size=cell_size) if cell_size > 0 else None
+
+    def __project(self, coordinates):
+        offsets = np.radians(coordinates - self.origin)
+        return EARTH_RADIUS * np.column_stack([offsets[:, 1] * self.lon_scale, offsets[:, 0]])
+
+    def __cells(self, coordinates):
+        return np.floor(self.__project(coordinates) / self.cell_size).astype(np.intp)
+
+    def __reach(self, radius):
+        # Cells from the cell of a query point to the farthest cell the
+        # circle may cross
+        return int(np.ceil(radius / (1 - self.tolerance) / self.cell_size)) + 1
+
+    def __stencil(self, radius):
+        with self.stencils_lock:
+            stencil = self.stencils.get(radius)
+            if stencil is not None:
+                self.stencils.move_to_end(radius)
+                return stencil
+
+        stencil = self.__build_stencil(radius)
+        with self.stencils_lock:
+            self.stencils[radius] = stencil
+            while len(self.stencils) > MAX_STENCILS:
+                self.stencils.popitem(last=False)
+        return stencil
+
+    def __build_stencil(self, radius):
+        # Cell offsets around the cell of a query point, split into the cells
+        # certainly within radius of any point of that cell (as one run of
+        # cells per row) and the cells the circle boundary may cross
+        inner = radius / (1 + self.tolerance) / self.cell_size
+        outer = radius / (1 - self.tolerance) / self.cell_size
+        reach = self.__reach(radius)
+
+        dy = np.arange(-reach, reach + 1)
+        half_widths = np.floor(np.sqrt(np.maximum(inner ** 2 - (np.abs(dy) + 1) ** 2, 0))) - 1
+        half_widths[(np.abs(dy) + 1) > inner] = -1
+        half_widths = half_widths.astype(np.intp)
+
+        dx, dy_all = np.meshgrid(np.arange(-reach, reach + 1), dy)
+        near = np.hypot(np.maximum(np.abs(dx) - 1, 0), np.maximum(np.abs(dy_all) - 1, 0))
+        crossed = (near <= outer) & (np.abs(dx) > half_widths[:, np.newaxis])
+
+        runs = half_widths >= 0
+        return dy[runs], half_widths[runs], dx[crossed], dy_all[crossed], reach
+
+    def count(self, central_points, radius):
+        # Per point counts of the points within radius flagged in each mask
+        # column, with the total in the last column
+        central_points = np.asarray(central_points, dtype=float).reshape(-1, 2)
+        # A stencil wider than the grid leaves no point on it, and would take
+        # memory quadratic in the radius to build
+        if 2 * self.__reach(radius) + 1 > min(self.shape):
+            return utils.count_within(self.index, self.masks, central_points, radius)
+
+        counts = np.zeros((len(central_points), self.masks.shape[1] + 1), dtype=np.int64)
+
+        run_dy, half_widths, crossed_dx, crossed_dy, reach = self.__stencil(radius)
+
+        # Only points whose whole stencil lies on the grid are counted here
+        cells = self.__cells(central_points)
+        on_grid = np.all((cells >= reach) & (cells < self.shape[::-1] - reach), axis=1)
+        gridded = np.flatnonzero(on_grid)
+        cx, cy = cells[gridded, 0, np.newaxis], cells[gridded, 1, np.newaxis]
+
+        # Cells wholly inside the circle, one run per row
+        y = cy + run_dy
+        counts[gridded] = (self.prefix[:, y, cx + half_widths + 1].astype(np.int64) -
+                           self.prefix[:, y, cx - half_widths]).sum(axis=2).T
+
+        # Points of the boundary cells, checked against the exact distance
+        cell_ids = ((cy + crossed_dy) * self.shape[1] + cx + crossed_dx).ravel()
+        starts = self.cell_offsets[cell_ids]
+        lengths = self.cell_offsets[cell_ids + 1] - starts
+        owners = np.repeat(np.repeat(gridded, len(crossed_dx)), lengths)
+        candidates = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+        queries = SpatialIndex.to_metres(central_points)
+        distances = np.sum((self.points[candidates] - queries[owners]) ** 2, axis=1)
+        within = distances <= SpatialIndex.to_chord(radius) ** 2
+
+        owners, flags = owners[within], self.masks[self.rows[candidates[within]]]
+        for column in range(flags.shape[1]):
+            counts[:, column] += np.bincount(owners[flags[:, column]], minlength=len(central_points))
+        counts[:, -1] += np.bincount(owners, minlength=len(central_points))
+
+        # Everything else goes to the spatial index
+        missed = np.flatnonzero(~on_grid)
+        if len(missed):
+            counts[missed] = utils.count_within(self.index, self.masks, central_points[missed], radius)
+
+        return counts
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    from modules.attribute_finder import LocationAttributeFinder
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description='Compare the count grid against exact radius queries')
+    parser.add_argument('--cell', type=float, default=100, help='cell size in metres')
+    parser.add_argument('--points', type=int, default=2000, help='number of query points')
+    parser.add_argument('--radii', type=int, nargs='+', default=[400, 800, 1200, 1600])
+    args = parser.parse_args()
+
+    finder = LocationAttributeFinder()
+    rng = np.random.default_rng(0)
+    uprns = finder.uprn_index.df[['UPRN_LATITUDE', 'UPRN_LONGITUDE']].to_numpy()
+    central_points = uprns[rng.choice(len(uprns), args.points)]
+
+    for name, target in (('transport', finder.transport_finder), ('school', finder.school_finder)):
+        with utils.Timer() as t:
+            grid = CountGrid(target.index, target.count_masks, cell_size=args.cell)
+            t.log(f'Built {name} grid of {grid.shape[0]} x {grid.shape[1]} cells')
+
+        for radius in args.radii:
+            started = time.perf_counter()
+            exact = utils.count_within(target.index, target.count_masks, central_points, radius)
+            exact_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            gridded = grid.count(central_points, radius)
+            grid_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for point in central_points[:200]:
+                grid.count([point], radius)
+            single_time = (time.perf_counter() - started) / 200
+
+            mismatches = int(np.any(exact != gridded, axis=1).sum())
+            print(f'{name} {radius}m: exact {exact_time:0.4f}s, grid {grid_time:0.4f}s '
+                  f'({single_time * 1e6:0.0f}us per single point), {mismatches} mismatches')
@@ -1,53 +1,304 @@
+import io
+import json
 import os
-from tempfile import NamedTemporaryFile
+import shutil
+import threading
+from tempfile import gettempdir
 
 import boto3
+import modules.metrics as metrics
 import modules.utils as utils
 import pandas as pd
+from botocore.exceptions import BotoCoreError, ClientError
+from modules.file_cache import LocalFileCache
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 
 class S3DataReader:
-    def __init__(self):
+    def __init__(self, s3=None, cache=None, offline=None, stream=None):
+        if s3 is None:
+            s3 = S3DataReader.__create_client()
+            # A forked worker must not share the pooled connections of its
+            # parent, e.g. the gunicorn master that loaded the app
+            os.register_at_fork(after_in_child=self.__recreate_client)
+
+        if cache is None:
+            cache = LocalFileCache(
+                os.environ.get('AVM_CACHE_DIR') or os.path.join(
+                    gettempdir(), 'avm-cache'),
+                max_bytes=int(os.environ.get(
+                    'AVM_CACHE_MAX_BYTES', 4 * 1024 ** 3))
+            )
+
+        if offline is None:
+            offline = os.environ.get('AVM_OFFLINE', '').lower() in (
+                '1', 'true', 'yes')
+
+        if stream is None:
+            stream = os.environ.get('AVM_STREAM_CSV', '').lower() in (
+                '1', 'true', 'yes')
+
+        self.s3 = s3
+        self.cache = cache
+        self.offline = offline
+        # Read CSVs straight from S3 rather than through the local cache
+        self.stream = stream and not offline
+        self.bucket_name = 'avm-area-data'
+
+        # Downloads started ahead of the stages that read them
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    @staticmethod
+    def __create_client():
         session = boto3.Session(
             aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
             aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
             region_name='eu-west-2'
         )
-        self.s3 = session.client('s3')
-        self.bucket_name = 'avm-area-data'
+        # A local stand-in such as benchmarks.s3_server instead of S3
+        return session.client('s3', endpoint_url=os.environ.get('AVM_S3_ENDPOINT_URL') or None)
+
+    def __recreate_client(self):
+        self.s3 = S3DataReader.__create_client()
+
+    def prefetch(self, keys, executor):
+        with self.lock:
+            for key in keys:
+                # Streamed CSVs are never downloaded as a whole
+                if self.stream and key.endswith('.csv'):
+                    continue
+                # An evicted source is only downloaded again if its converted
+                # copy turns out to be gone too (see load_file)
+                if not key.endswith('.parquet') and self.__is_evicted(key):
+                    continue
+                if key not in self.pending:
+                    self.pending[key] = executor.submit(self.__fetch, key)
+
+    def discard_prefetched(self):
+        # Drops the downloads no stage picked up, e.g. after a failed start
+        # up, so that the next fetch of those keys revalidates against S3
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for future in pending.values():
+            future.cancel()
+
+    def fetch(self, key):
+        with self.lock:
+            pending = self.pending.pop(key, None)
+
+        if pending is not None:
+            return pending.result()
+
+        return self.__fetch(key)
+
+    def get_etags(self, keys):
+        # Current ETag of each object, from the cache when offline. None when
+        # it cannot be read, so that an unreachable S3 never looks like a change
+        etags = {}
+        for key in keys:
+            if self.offline:
+                ref = self.cache.get_ref(self.bucket_name, key)
+                etags[key] = ref and ref['etag']
+                continue
+
+            try:
+                etags[key] = self.s3.head_object(Bucket=self.bucket_name, Key=key)['ETag']
+            except (BotoCoreError, ClientError) as e:
+                print(f'Could not read the ETag of {key} ({e})')
+                etags[key] = None
+
+        return etags
+
+    def __fetch(self, key):
+        # Return a local path for the object, downloading it only when the
+        # cached copy is missing or its ETag no longer matches S3
+        ref = self.cache.get_ref(self.bucket_name, key)
+
+        if self.offline:
+            if ref is None:
+                raise FileNotFoundError(
+                    f'{key} is not cached and offline mode is enabled')
+            self.cache.touch(ref['path'])
+            return ref['path']
+
+        try:
+            if ref is None:
+                head = self.s3.head_object(Bucket=self.bucket_name, Key=key)
+            else:
+                head = self.s3.head_object(
+                    Bucket=self.bucket_name, Key=key, IfNoneMatch=ref['etag'])
+
+        except ClientError as e:
+            if ref is not None and e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                self.cache.touch(ref['path'])
+                return ref['path']
+            raise
+
+        except BotoCoreError as e:
+            # S3 is unreachable, fall back to the last snapshot if there is one
+            if ref is None:
+                raise
+            print(f'S3 unavailable ({e}), using cached {key}')
+            self.cache.touch(ref['path'])
+            return ref['path']
+
+        etag = head['ETag']
+
+        # download_fileobj takes no IfMatch, so the object is streamed from a
+        # conditional GET to be sure it is the version whose ETag is stored
+        return self.cache.store(
+            self.bucket_name, key, etag,
+            lambda f: shutil.copyfileobj(self.s3.get_object(
+                Bucket=self.bucket_name, Key=key, IfMatch=etag)['Body'], f, 1024 * 1024)
+        )
+
+    def load_file(self, name, type, load=None, options=None):
+        # options are passed to the pandas reader of the file type. A file read
+        # with options is converted to parquet on first load, keyed by its ETag
+        # and the options, and later loads read the parquet copy instead,
+        # fetching the source only when the copy is missing or out of date.
+        key = f'{name}.{type}'
 
-    def load_file(self, name, type, load=None):
         with utils.Timer() as t:
-            t.log(f'Loading {name}.{type} from S3')
-
-            with NamedTemporaryFile(delete=False) as temp_file:
-                file_path = temp_file.name
-                t.log(f'Temporary file created at {file_path}')
-
-                self.s3.download_fileobj(
-                    self.bucket_name, f'{name}.{type}', temp_file)
-
-                try:
-                    with open(file_path, 'rb') as file_buffer:
-                        if load:
-                            df = load(file_buffer)
-                        else:
-                            if type == 'csv':
-                                df = pd.read_csv(
-                                    file_buffer, encoding='ISO-8859-1', low_memory=False
-                                )
-                            elif type == 'xlsx':
-                                df = pd.read_excel(file_buffer)
-                            elif type == 'parquet':
-                                df = pd.read_parquet(file_buffer)
-                            else:
-                                raise ValueError(
-                                    f"Unsupported file type: {type}")
-
-                finally:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
+            t.log(f'Loading {key} from S3')
+
+            converted_path = self.__find_converted(key, type, options)
+            if converted_path is not None:
+                # A prefetch of the source is no longer needed
+                self.__discard(key)
+                df = pd.read_parquet(converted_path)
+                t.log(f'Loaded {len(df)} rows from converted copy')
+                metrics.registry.set_gauge('avm_dataset_load_seconds', t.elapsed(), dataset=key)
+                return df
+
+            file_path = self.fetch(key)
+            t.log(f'Local copy available at {file_path}')
+
+            with open(file_path, 'rb') as file_buffer:
+                if load:
+                    df = load(file_buffer)
+                else:
+                    df = S3DataReader.__read(file_buffer, type, options or {})
 
             t.log(f'Loaded {len(df)} rows')
 
+            ref = self.cache.get_ref(self.bucket_name, key)
+            if ref is not None and options is not None and type != 'parquet':
+                self.__convert(df, self.__converted_path(key, ref['etag'], options))
+                t.log(f'Converted to parquet')
+
+            metrics.registry.set_gauge('avm_dataset_load_seconds', t.elapsed(), dataset=key)
+
+        return df
+
+    def load_csv(self, name, options=None, keep=None, chunksize=100000):
+        # keep returns the mask of the rows to keep from a frame. When streaming
+        # it is applied to each chunk as it is read from the S3 response body,
+        # so neither the whole file nor a copy of it on disk is ever needed.
+        if not self.stream:
+            df = self.load_file(name, 'csv', options=options)
+            return df if keep is None else df[keep(df)]
+
+        key = f'{name}.csv'
+
+        with utils.Timer() as t:
+            t.log(f'Streaming {key} from S3')
+
+            options = {'encoding': 'ISO-8859-1', **(options or {})}
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+
+            # Decoded as it is read, pandas does not see the body as binary
+            body = io.TextIOWrapper(response['Body'], encoding=options.pop('encoding'))
+            chunks = pd.read_csv(body, chunksize=chunksize, **options)
+
+            rows = 0
+            kept = []
+            for chunk in chunks:
+                rows += len(chunk)
+                kept.append(chunk if keep is None else chunk[keep(chunk)])
+
+            df = pd.concat(kept, ignore_index=True)
+            t.log(f'Kept {len(df)} of {rows} rows')
+            metrics.registry.set_gauge('avm_dataset_load_seconds', t.elapsed(), dataset=key)
+
         return df
+
+    def __converted_path(self, key, etag, options):
+        return self.cache.derived_path(self.bucket_name, key, etag, 'parquet',
+                                       json.dumps(options, sort_keys=True))
+
+    def __find_converted(self, key, type, options):
+        # Converted copy of the current version of the object, looked up by
+        # the ETag fetched last so that an evicted source is not downloaded
+        # again only to find the copy. None when there is none.
+        if options is None or type == 'parquet':
+            return None
+
+        etag = self.cache.get_etag(self.bucket_name, key)
+        if etag is None:
+            return None
+
+        path = self.__converted_path(key, etag, options)
+        if not os.path.exists(path) or not self.__is_current(key, etag):
+            return None
+
+        self.cache.touch(path)
+        return path
+
+    def __is_current(self, key, etag):
+        # Whether S3 still holds the version with this ETag, assumed when
+        # offline or unreachable as the cached snapshot is used then anyway
+        if self.offline:
+            return True
+
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=key, IfNoneMatch=etag)
+        except ClientError as e:
+            return e.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+        except BotoCoreError as e:
+            print(f'S3 unavailable ({e}), using the converted copy of {key}')
+            return True
+
+        return False
+
+    def __is_evicted(self, key):
+        return self.cache.get_etag(self.bucket_name, key) is not None and self.cache.get_ref(
+            self.bucket_name, key) is None
+
+    def __discard(self, key):
+        with self.lock:
+            pending = self.pending.pop(key, None)
+
+        if pending is not None:
+            pending.cancel()
+
+    def __convert(self, df, path):
+        try:
+            self.cache.store_file(path, lambda f: df.to_parquet(f))
+        except (ValueError, TypeError, ImportError) as e:
+            # e.g. object columns mixing strings and numbers; the source file
+            # is simply parsed again next time
+            print(f'Could not convert to parquet ({e})')
+
+    @staticmethod
+    def __read(file_buffer, type, options):
+        if type == 'csv':
+            options = {'encoding': 'ISO-8859-1', **options}
+            # The pyarrow parser is multithreaded and only materialises the
+            # projected columns
+            if pyarrow is not None and 'usecols' in options:
+                return pd.read_csv(file_buffer, engine='pyarrow', **options)
+            return pd.read_csv(file_buffer, low_memory=False, **options)
+        elif type == 'xlsx':
+            return pd.read_excel(file_buffer, **options)
+        elif type == 'parquet':
+            return pd.read_parquet(file_buffer, **options)
+        else:
+            raise ValueError(
+                f"Unsupported file type: {type}")
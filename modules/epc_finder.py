@@ -1,3 +1,4 @@
+import modules.schema as schema
 from modules.kd_tree_finder import KDTreeFinder
 
 
@@ -9,6 +10,8 @@ class EPCFinder(KDTreeFinder):
         self.df = EPCFinder.__enrich_epc_data(self.df, uprn_df)
         super().__init__(self.df, 'UPRN_LATITUDE', 'UPRN_LONGITUDE')
 
+        self.df, self.memory_usage = schema.compact_indexed(self.df, 'UPRN_LATITUDE', 'UPRN_LONGITUDE')
+
     @staticmethod
     def __enrich_epc_data(df, uprn_df):
         # Drop records with no UPRN
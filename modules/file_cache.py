@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+from tempfile import NamedTemporaryFile
+
+
+# Content-addressed on-disk cache of S3 objects. Objects are stored under
+# objects/ named by the digest of bucket/key/ETag, and a ref file under refs/
+# points each bucket/key at the ETag fetched last. Writes go through a temporary
+# file and an atomic rename so several worker processes can share a directory.
+class LocalFileCache:
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.refs_dir = os.path.join(directory, 'refs')
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    @staticmethod
+    def digest(*parts):
+        return hashlib.sha256('/'.join(parts).encode('utf-8')).hexdigest()
+
+    def object_path(self, bucket, key, etag):
+        return os.path.join(self.objects_dir, LocalFileCache.digest(bucket, key, etag))
+
+    def derived_path(self, bucket, key, etag, *selection):
+        # Files derived from an object, e.g. a parquet conversion, live next to
+        # it and are evicted the same way
+        return os.path.join(self.objects_dir, LocalFileCache.digest(bucket, key, etag, *selection))
+
+    def store_file(self, path, write):
+        with NamedTemporaryFile(dir=self.objects_dir, prefix='.tmp-', delete=False) as temp_file:
+            try:
+                write(temp_file)
+            except BaseException:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+
+        os.replace(temp_file.name, path)
+        self.evict(keep=path)
+
+        return path
+
+    def __ref_path(self, bucket, key):
+        return os.path.join(self.refs_dir, LocalFileCache.digest(bucket, key) + '.json')
+
+    def get_etag(self, bucket, key):
+        # ETag fetched last, even if the object itself has since been evicted
+        try:
+            with open(self.__ref_path(bucket, key), 'r') as ref_file:
+                return json.load(ref_file)['etag']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get_ref(self, bucket, key):
+        etag = self.get_etag(bucket, key)
+        if etag is None:
+            return None
+
+        path = self.object_path(bucket, key, etag)
+        if not os.path.exists(path):
+            return None
+
+        return {'etag': etag, 'path': path}
+
+    def touch(self, path):
+        # Modification time doubles as the last access time for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def store(self, bucket, key, etag, write):
+        path = self.store_file(self.object_path(bucket, key, etag), write)
+        self.__write_ref(bucket, key, etag)
+
+        return path
+
+    def __write_ref(self, bucket, key, etag):
+        with NamedTemporaryFile('w', dir=self.refs_dir, prefix='.tmp-', delete=False) as temp_file:
+            json.dump({'bucket': bucket, 'key': key, 'etag': etag}, temp_file)
+
+        os.replace(temp_file.name, self.__ref_path(bucket, key))
+
+    def evict(self, keep=None):
+        # Remove the least recently used objects until the cache fits in max_bytes
+        if not self.max_bytes:
+            return
+
+        entries = []
+        for entry in os.scandir(self.objects_dir):
+            if entry.name.startswith('.tmp-') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
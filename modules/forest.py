@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class FlatForest:
+    # The node arrays of every tree in a fitted forest concatenated into one
+    # set of arrays, so that all trees are traversed together with NumPy
+    # instead of calling predict on each tree in turn
+    def __init__(self, estimators):
+        trees = [estimator.tree_ for estimator in estimators]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+
+        left = np.concatenate([tree.children_left + offset
+                               for tree, offset in zip(trees, offsets)])
+        right = np.concatenate([tree.children_right + offset
+                                for tree, offset in zip(trees, offsets)])
+        is_leaf = np.concatenate([tree.children_left == -1 for tree in trees])
+        nodes = np.arange(len(is_leaf))
+
+        # Leaves point back at themselves so that every path can be walked for
+        # the same number of steps
+        self.roots = offsets
+        self.left = np.where(is_leaf, nodes, left)
+        self.right = np.where(is_leaf, nodes, right)
+        self.feature = np.where(is_leaf, 0, np.concatenate(
+            [tree.feature for tree in trees]))
+        self.threshold = np.concatenate([tree.threshold for tree in trees])
+        self.value = np.concatenate([tree.value[:, 0, 0] for tree in trees])
+        self.max_depth = max(tree.max_depth for tree in trees)
+
+        if all(hasattr(tree, 'missing_go_to_left') for tree in trees):
+            self.missing_go_to_left = np.concatenate(
+                [tree.missing_go_to_left for tree in trees]).astype(bool)
+        else:
+            self.missing_go_to_left = None
+
+    def predict(self, X):
+        if hasattr(X, 'toarray'):
+            X = X.toarray()
+
+        # Trees compare float32 features against their thresholds
+        X = np.asarray(X, dtype=np.float32)
+        columns = np.arange(X.shape[0])
+        nodes = np.repeat(self.roots[:, np.newaxis], X.shape[0], axis=1)
+
+        for _ in range(self.max_depth):
+            values = X[columns, self.feature[nodes]]
+            go_left = values <= self.threshold[nodes]
+
+            if self.missing_go_to_left is not None:
+                go_left = np.where(np.isnan(values),
+                                   self.missing_go_to_left[nodes], go_left)
+
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        # One row per tree and one column per record
+        return self.value[nodes]
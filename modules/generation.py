@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+
+import modules.metrics as metrics
+import modules.utils as utils
+from modules.file_cache import LocalFileCache
+
+# Seconds between checks of the reload marker
+MARKER_INTERVAL = 1
+
+
+class Generation:
+    # One model and set of finders built from the same datasets. Requests
+    # take the current generation once and use it throughout, so a reload
+    # never mixes two generations within a request.
+    def __init__(self, id, loaded, etags, timings):
+        self.id = id
+        self.model = loaded['model']
+        self.finder = loaded['finder']
+        self.etags = etags
+        self.timings = timings
+        self.loaded_at = time.time()
+
+    def get_status(self):
+        return {
+            'id': self.id,
+            'version': self.finder.version,
+            'loaded_at': self.loaded_at,
+            'load_times': self.timings
+        }
+
+
+class GenerationManager:
+    # Builds each new generation in the background while the current one
+    # keeps serving, and swaps it in with a single assignment once it is
+    # ready. build is called with the version of the watched objects and the
+    # previous generation (None at start up), and returns the loaded objects
+    # and the stage timings.
+    def __init__(self, reader, build, keys, interval=None, marker=None):
+        self.reader = reader
+        self.build = build
+        self.keys = tuple(keys)
+        self.interval = float(os.environ.get('AVM_RELOAD_INTERVAL', 0)
+                              ) if interval is None else interval
+        # File in the cache directory all the workers share, rewritten to ask
+        # every one of them to reload
+        self.marker = marker or os.environ.get('AVM_RELOAD_MARKER') or os.path.join(
+            reader.cache.directory, 'reload-requested')
+        self.lock = threading.Lock()
+        self.reloading = None
+        self.last_error = None
+        self.watcher = None
+
+        # Requests made before this point are covered by the first build
+        self.marker_seen = self.__read_marker()
+        self.current = self.__build(1, None)
+        metrics.registry.set_gauge('avm_generation', self.current.id)
+
+    def __build(self, id, previous):
+        etags = self.reader.get_etags(self.keys)
+
+        with utils.Timer() as t:
+            t.log(f'Building generation {id}')
+            loaded, timings = self.build(GenerationManager.get_version(etags), previous)
+            t.log(f'Generation {id} ready')
+
+        return Generation(id, loaded, etags, timings)
+
+    @staticmethod
+    def get_version(etags):
+        return LocalFileCache.digest(*(f'{key}={etag}' for key, etag in sorted(etags.items())))
+
+    def reload(self):
+        # Starts building the next generation unless one is already on its
+        # way. Returns whether a build was started.
+        with self.lock:
+            if self.reloading is not None:
+                return False
+
+            self.reloading = threading.Thread(target=self.__reload, daemon=True)
+            self.reloading.start()
+
+        return True
+
+    def __reload(self):
+        previous = self.current
+
+        try:
+            generation = self.__build(previous.id + 1, previous)
+            # Requests already running finish on the previous generation
+            self.current = generation
+            self.last_error = None
+            metrics.registry.set_gauge('avm_generation', generation.id)
+        except Exception as e:
+            # Keep serving the previous generation
+            print(f'Reload failed ({e!r}), still serving generation {previous.id}')
+            self.last_error = repr(e)
+        finally:
+            with self.lock:
+                self.reloading = None
+
+    def has_changed(self):
+        # True when every watched object could be read and one of them no
+        # longer matches the current generation
+        etags = self.reader.get_etags(self.keys)
+        return None not in etags.values() and etags != self.current.etags
+
+    def request_reload(self):
+        # Reloads this worker and has the watchers of every other worker
+        # sharing the marker reload too. Returns whether a build was started.
+        if self.reloading is not None:
+            return False
+
+        token = f'{os.getpid()}-{time.time_ns()}'
+        temporary = f'{self.marker}.{os.getpid()}'
+        with open(temporary, 'w') as f:
+            f.write(token)
+        os.replace(temporary, self.marker)
+        self.marker_seen = token
+
+        return self.reload()
+
+    def __read_marker(self):
+        try:
+            with open(self.marker, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def watch(self):
+        # Polls the reload marker, and when AVM_RELOAD_INTERVAL is set the
+        # ETags of the watched objects every interval seconds, reloading when
+        # a reload was requested or any object changed
+        if self.watcher is not None:
+            return
+
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.__watch, daemon=True)
+                self.watcher.start()
+
+    def __watch(self):
+        checked = time.monotonic()
+
+        while True:
+            time.sleep(MARKER_INTERVAL)
+            try:
+                token = self.__read_marker()
+                # Left for the next check while a build is running
+                if token != self.marker_seen and self.reload():
+                    print('Reload requested, reloading')
+                    self.marker_seen = token
+
+                if self.interval > 0 and time.monotonic() - checked >= self.interval:
+                    checked = time.monotonic()
+                    if self.reloading is None and self.has_changed():
+                        print('Watched objects changed, reloading')
+                        self.reload()
+            except Exception as e:
+                print(f'Could not check for changes ({e!r})')
+
+    def get_status(self):
+        return {
+            **self.current.get_status(),
+            'reloading': self.reloading is not None,
+            'last_error': self.last_error
+        }
@@ -1,28 +1,20 @@
-import pandas as pd
-from modules.kd_tree_finder import KDTreeFinder
-
-
-class GreenSpaceFinder(KDTreeFinder):
-    def __init__(self, reader, onsud_df):
+class GreenSpaceFinder:
+    def __init__(self, reader, uprn_index):
         self.reader = reader
+        self.uprn_index = uprn_index
 
-        private_space_df = self.__load_private_outdoor_space_data()
-        green_space_df = self.__load_public_green_space_data()
-
-        self.df = GreenSpaceFinder.__enrich_onsud_data(
-            private_space_df, green_space_df, onsud_df
-        )
-        super().__init__(self.df, 'UPRN_LATITUDE', 'UPRN_LONGITUDE')
+        self.private_space_df = self.__load_private_outdoor_space_data()
+        self.green_space_df = self.__load_public_green_space_data()
 
     def __load_private_outdoor_space_data(self):
         df = self.reader.load_file(
             name='osprivateoutdoorspacereferencetables',
             type='xlsx',
-            load=lambda f: pd.read_excel(f, header=1, sheet_name=4)
+            # Only keep the columns we need
+            options={'header': 1, 'sheet_name': 4,
+                     'usecols': [6, 7, 9, 10, 11, 12, 13, 15, 16, 17, 18, 19, 20]}
         )
 
-        # Only keep the columns we need
-        df = df.iloc[:, [6, 7, 9, 10, 11, 12, 13, 15, 16, 17, 18, 19, 20]]
         df.columns = ['MSOA', 'MSOAName', 'HouseWithPOS', 'HouseTotalPOS', 'HouseWithPOSPct', 'HouseAvgPOS',
                       'HouseMedPOS', 'FlatWithPOS', 'FlatTotalPOS', 'FlatPOSCount', 'FlatWithPOSPct', 'FlatAvgPOS', 'FlatPOSShare']
 
@@ -35,11 +27,11 @@ class GreenSpaceFinder(KDTreeFinder):
         df = self.reader.load_file(
             name='ospublicgreenspacereferencetables',
             type='xlsx',
-            load=lambda f: pd.read_excel(f, header=0, sheet_name=7)
+            # Only keep the columns we need
+            options={'header': 0, 'sheet_name': 7,
+                     'usecols': [8, 9, 12, 13, 14, 15]}
         )
 
-        # Only keep the columns we need
-        df = df.iloc[:, [8, 9, 12, 13, 14, 15]]
         df.columns = ['LSOA', 'LSOAName',
                       'NearestParkDistanceAvg', 'NearestParkSizeAvg',
                       '1kParkCountAvg', '1kParkSizeAvg']
@@ -49,13 +41,29 @@ class GreenSpaceFinder(KDTreeFinder):
 
         return df
 
-    @staticmethod
-    def __enrich_onsud_data(private_space_df, green_space_df, onsud_df):
-        enriched_df = onsud_df[['UPRN_LATITUDE', 'UPRN_LONGITUDE',
-                                'CPO_LSOA', 'CPO_MSOA']]
+    def get_fields(self):
+        return ['UPRN_LATITUDE', 'UPRN_LONGITUDE'] + list(self.private_space_df.columns) + list(self.green_space_df.columns)
+
+    def resolve(self, uprn_matches, columns=None):
+        private_space_df = self.private_space_df
+        green_space_df = self.green_space_df
+
+        # Only merge the requested attributes
+        if columns is not None:
+            private_space_df = private_space_df[[
+                c for c in private_space_df.columns if c in columns]]
+            green_space_df = green_space_df[[
+                c for c in green_space_df.columns if c in columns]]
+
+        # Attach the MSOA and LSOA level green space attributes to the matched UPRNs
+        enriched_df = uprn_matches[['UPRN_LATITUDE', 'UPRN_LONGITUDE',
+                                    'CPO_LSOA', 'CPO_MSOA']]
         enriched_df = enriched_df.merge(
             private_space_df, how='left', left_on='CPO_MSOA', right_index=True)
         enriched_df = enriched_df.merge(
             green_space_df, how='left', left_on='CPO_LSOA', right_index=True)
         enriched_df.drop(columns=['CPO_LSOA', 'CPO_MSOA'], inplace=True)
-        return enriched_df
+        return enriched_df if columns is None else enriched_df[list(columns)]
+
+    def get_closest_matches(self, central_point, top_n=5, columns=None):
+        return self.resolve(self.uprn_index.get_closest_matches(central_point, top_n=top_n), columns)
@@ -1,26 +1,19 @@
-import pandas as pd
-from modules.kd_tree_finder import KDTreeFinder
-
-
-class IMDFinder(KDTreeFinder):
-    def __init__(self, reader, onsud_df):
+class IMDFinder:
+    def __init__(self, reader, uprn_index):
         self.reader = reader
+        self.uprn_index = uprn_index
 
         self.df = self.__load_data()
-        self.df = IMDFinder.__enrich_onsud_data(
-            self.df, onsud_df
-        )
-        super().__init__(self.df, 'UPRN_LATITUDE', 'UPRN_LONGITUDE')
 
     def __load_data(self):
         df = self.reader.load_file(
             name='File_2_-_IoD2019_Domains_of_Deprivation',
             type='xlsx',
-            load=lambda f: pd.read_excel(f, header=1, sheet_name=1)
+            # Only keep the columns we need
+            options={'header': 1, 'sheet_name': 1,
+                     'usecols': [0, 1, 5, 7, 9, 11, 13, 15, 17]}
         )
 
-        # Only keep the columns we need
-        df = df.iloc[:, [0, 1, 5, 7, 9, 11, 13, 15, 17]]
         df.columns = ['LSOA', 'LSOAName', 'IMDDecile', 'IncDecile',
                       'EmpDecile', 'EduDecile',  'CrmDecile', 'HouseBarDecile', 'EnvDecile']
 
@@ -29,10 +22,22 @@ class IMDFinder(KDTreeFinder):
 
         return df
 
-    @staticmethod
-    def __enrich_onsud_data(df, onsud_df):
-        enriched_df = onsud_df[['UPRN_LATITUDE', 'UPRN_LONGITUDE', 'CPO_LSOA']]
+    def get_fields(self):
+        return ['UPRN_LATITUDE', 'UPRN_LONGITUDE'] + list(self.df.columns)
+
+    def resolve(self, uprn_matches, columns=None):
+        df = self.df
+
+        # Only merge the requested attributes
+        if columns is not None:
+            df = df[[c for c in df.columns if c in columns]]
+
+        # Attach the LSOA level deprivation deciles to the matched UPRNs
+        enriched_df = uprn_matches[['UPRN_LATITUDE', 'UPRN_LONGITUDE', 'CPO_LSOA']]
         enriched_df = enriched_df.merge(
             df, how='left', left_on='CPO_LSOA', right_index=True)
         enriched_df.drop(columns=['CPO_LSOA'], inplace=True)
-        return enriched_df
+        return enriched_df if columns is None else enriched_df[list(columns)]
+
+    def get_closest_matches(self, central_point, top_n=5, columns=None):
+        return self.resolve(self.uprn_index.get_closest_matches(central_point, top_n=top_n), columns)
@@ -1,24 +1,91 @@
+import os
+
+import modules.utils as utils
+import numpy as np
 import pandas as pd
-from scipy.spatial import KDTree
+from modules.spatial_index import SpatialIndex
+
+# Most rows tied with the last of the top n that are added to a match
+MAX_TIES = int(os.environ.get('AVM_MAX_TIES', 100))
+
+# Relative difference in distance below which two points count as tied
+TIE_TOLERANCE = 1e-9
 
 
 class KDTreeFinder:
     def __init__(self, df, lat_col, lon_col):
         self.df = df
-        self.dtypes = self.df.dtypes
-        self.tree = KDTree(self.df[[lat_col, lon_col]].values)
 
-    def get_closest_matches(self, central_point, top_n=5):
-        # Start by querying for the top_n points
-        distances, indices = self.tree.query([central_point], k=top_n)
+        # Many rows share a coordinate (e.g. flats in one block), so the index
+        # only holds the distinct coordinates. The rows at point i are
+        # point_rows[point_offsets[i]:point_offsets[i + 1]].
+        lat_codes, lats = pd.factorize(self.df[lat_col].to_numpy(dtype=float))
+        lon_codes, lons = pd.factorize(self.df[lon_col].to_numpy(dtype=float))
+        inverse, points = pd.factorize(lat_codes.astype(np.int64) * len(lons) + lon_codes)
+
+        self.point_rows = np.argsort(inverse, kind='stable')
+        self.point_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(inverse, minlength=len(points)))])
+        self.index = SpatialIndex(np.column_stack([lats[points // len(lons)], lons[points % len(lons)]]))
+
+    def get_fields(self):
+        return list(self.df.columns)
+
+    def __rows_at(self, points):
+        return np.concatenate([self.point_rows[self.point_offsets[point]:self.point_offsets[point + 1]]
+                               for point in points])
+
+    def query_closest(self, central_points, top_n=5, max_ties=None):
+        # Row indices of the top_n closest rows to each of the given points,
+        # extended with the rows tied with the last of them (up to max_ties)
+        central_points = np.asarray(central_points, dtype=float).reshape(-1, 2)
+        max_ties = MAX_TIES if max_ties is None else max_ties
+        top_n = min(top_n, len(self.df))
+
+        if top_n < 1:
+            return [np.empty(0, dtype=np.intp) for _ in central_points]
+
+        # The top_n closest points hold at least top_n rows, and one extra
+        # point tells whether another coordinate ties with the last of them.
+        # A single closest match is never extended.
+        k = min(top_n + 1, self.index.n) if top_n > 1 else 1
+        distances, indices = self.index.query(central_points, k=k)
+
+        # Number of points needed to cover top_n rows for each query
+        counts = self.point_offsets[indices + 1] - self.point_offsets[indices]
+        needed = np.argmax(np.cumsum(counts, axis=1) >= top_n, axis=1) + 1
+        points = [indices[i, :n] for i, n in enumerate(needed)]
+
+        if top_n > 1 and max_ties > 0:
+            # Points as far as the last match up to a rounding error, e.g. its
+            # mirror image across the query point, tie with it
+            last = distances[np.arange(len(needed)), needed - 1] * (1 + TIE_TOLERANCE)
+            tied = np.flatnonzero((needed < k) & (
+                distances[np.arange(len(needed)), np.minimum(needed, k - 1)] <= last))
+
+            if len(tied):
+                # Every point within the distance of the last match, in a
+                # single query
+                radii = last[tied]
+                within = self.index.query_radius(central_points[tied], radii)
+
+                for i, extra in zip(tied, within):
+                    extra = np.setdiff1d(extra, points[i])
+                    points[i] = np.concatenate([points[i], extra])
+
+        limit = top_n + max_ties if top_n > 1 else 1
+        return [self.__rows_at(match)[:limit] for match in points]
+
+    def get_closest_matches(self, central_point, top_n=5, columns=None):
+        return utils.select(self.df, self.query_closest([central_point], top_n)[0], columns)
 
-        # If there are ties at the end of the list, query for more points
-        while top_n > 1 and distances[0][-1] == distances[0][-2]:
-            top_n += 1
-            distances, indices = self.tree.query([central_point], k=top_n)
+    def get_closest_matches_batch(self, central_points, top_n=5, columns=None):
+        return [utils.select(self.df, rows, columns) for rows in self.query_closest(central_points, top_n)]
 
-        # Get the closest points in the DataFrame
-        match = self.df.iloc[indices[0]]
+    def get_nearest_matches(self, central_points):
+        # First row at the closest point for each of the given points, in the
+        # same order
+        _, indices = self.index.query(central_points, k=1)
 
-        # If the result is a Series, convert it to a DataFrame so that it can be serialised to JSON
-        return match if isinstance(match, pd.DataFrame) else match.to_frame().T.astype(self.dtypes)
+        with utils.Timer('slice'):
+            return self.df.iloc[self.point_rows[self.point_offsets[indices[:, 0]]]]
@@ -0,0 +1,104 @@
+import contextvars
+import os
+import threading
+from bisect import bisect_left
+
+# Upper bounds of the latency buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+STAGE_HISTOGRAM = 'avm_stage_seconds'
+
+GAUGES = {
+    'avm_dataset_load_seconds': 'Seconds taken to load each dataset',
+    'avm_startup_stage_seconds': 'Seconds taken by each start up stage',
+    'avm_generation': 'Id of the generation being served'
+}
+
+# Endpoint of the request being served, set once per request and copied
+# into the threads the request fans out to
+endpoint = contextvars.ContextVar('endpoint', default='')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    # Per process histograms of the time spent in each stage of a request,
+    # per stage and endpoint, and gauges set at load time. Each worker keeps
+    # its own, so a scrape reports the worker that answered it.
+    def __init__(self, enabled=True, buckets=LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.gauges = {}
+
+    @staticmethod
+    def from_env():
+        return MetricsRegistry(enabled=os.environ.get('AVM_METRICS', '1').lower() not in ('0', 'false', 'no'))
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+
+        key = (stage, endpoint.get())
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def set_gauge(self, name, value, **labels):
+        if name not in GAUGES:
+            raise ValueError(f'Unknown gauge: {name}')
+
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        # Prometheus text exposition format
+        with self.lock:
+            histograms = {key: (list(histogram.counts), histogram.sum)
+                          for key, histogram in self.histograms.items()}
+            gauges = dict(self.gauges)
+
+        lines = [f'# HELP {STAGE_HISTOGRAM} Seconds spent in each stage of a request',
+                 f'# TYPE {STAGE_HISTOGRAM} histogram']
+        for (stage, name), (counts, total) in sorted(histograms.items()):
+            labels = f'stage="{escape(stage)}",endpoint="{escape(name)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{STAGE_HISTOGRAM}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{STAGE_HISTOGRAM}_sum{{{labels}}} {total}')
+            lines.append(f'{STAGE_HISTOGRAM}_count{{{labels}}} {cumulative}')
+
+        for gauge, description in GAUGES.items():
+            values = sorted((labels, value) for (name, labels), value in gauges.items() if name == gauge)
+            if not values:
+                continue
+
+            lines += [f'# HELP {gauge} {description}', f'# TYPE {gauge} gauge']
+            for labels, value in values:
+                labels = ','.join(f'{label}="{escape(str(text))}"' for label, text in labels)
+                lines.append(f'{gauge}{{{labels}}} {value}' if labels else f'{gauge} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry.from_env()
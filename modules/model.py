@@ -1,63 +1,107 @@
 import os
-from tempfile import NamedTemporaryFile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 import joblib as jl
+import modules.metrics as metrics
 import modules.utils as utils
 import numpy as np
+from modules.data_reader import S3DataReader
+from modules.forest import FlatForest
+
+PREDICT_MODES = ('serial', 'threads', 'flat')
 
 
 class Model:
-    def __init__(self):
-        bucket_name = 'avm-area-data'
-        model_name = 'model.joblib'
+    model_name = 'model.joblib'
+
+    def __init__(self, reader=None, mode=None, n_jobs=None):
+        model_name = Model.model_name
+        reader = reader or S3DataReader()
 
-        s3 = boto3.client('s3',
-                          aws_access_key_id=os.environ.get(
-                              "AWS_ACCESS_KEY_ID"),
-                          aws_secret_access_key=os.environ.get(
-                              "AWS_SECRET_ACCESS_KEY"),
-                          region_name='eu-west-2')
+        self.mode = mode or os.environ.get('AVM_PREDICT_MODE', 'serial')
+        if self.mode not in PREDICT_MODES:
+            raise ValueError(f'Unsupported prediction mode: {self.mode}')
+
+        # Share the cores between the gunicorn workers rather than letting
+        # every worker start a thread per core
+        self.n_jobs = n_jobs or int(os.environ.get('AVM_PREDICT_JOBS', 0)) or max(
+            1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1)))
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.flat_forest = None
 
         with utils.Timer() as t:
             t.log(f'Loading model {model_name} from S3')
 
-            with NamedTemporaryFile(delete=False) as temp_file:
-                file_path = temp_file.name
-                t.log(f'Temporary file created at {file_path}')
+            file_path = reader.fetch(model_name)
+            t.log(f'Local copy available at {file_path}')
 
-                s3.download_fileobj(bucket_name, model_name, temp_file)
+            with open(file_path, 'rb') as file_buffer:
+                self.model = jl.load(file_buffer)
+                t.log(f'Loaded model {model_name}')
 
-                try:
-                    with open(file_path, 'rb') as file_buffer:
-                        self.model = jl.load(file_buffer)
-                        t.log(f'Loaded model {model_name}')
+            if self.mode == 'flat':
+                self.flat_forest = FlatForest(
+                    self.model.named_steps['extratreesregressor'].estimators_)
+                t.log(f'Flattened {len(self.flat_forest.roots)} trees')
 
-                finally:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
+            metrics.registry.set_gauge('avm_dataset_load_seconds', t.elapsed(), dataset=model_name)
 
     def predict(self, df):
         try:
-            processed_df = df.copy()
-            pipeline = self.model.named_steps['pipeline']
-
-            processed_df = pipeline.named_steps['invalidvaluecleaner'].transform(
-                processed_df)
-            processed_df = pipeline.named_steps['stringcleaner'].transform(
-                processed_df)
-            processed_df = pipeline.named_steps['columntransformer'].transform(
-                processed_df)
-
-            best_fit = self.model.named_steps['extratreesregressor']
-
-            predictions = np.array([tree.predict(processed_df)
-                                   for tree in best_fit.estimators_])
-
-            return {
-                'lower_bound': np.percentile(predictions, 10),
-                'upper_bound': np.percentile(predictions, 90),
-                'prediction': self.model.predict(df).tolist()[0]
-            }
+            return self.predict_batch(df)[0]
         except Exception as e:
             return print(e)
+
+    def predict_batch(self, df):
+        with utils.Timer('preprocess'):
+            processed_df = self.__preprocess(df)
+
+        # One row per tree and one column per record
+        with utils.Timer('inference'):
+            predictions = self.__predict_trees(processed_df)
+
+        with utils.Timer('percentiles'):
+            lower_bounds = np.percentile(predictions, 10, axis=0)
+            upper_bounds = np.percentile(predictions, 90, axis=0)
+
+            # ExtraTreesRegressor predicts the mean of its trees, so the point
+            # estimate comes from the same matrix instead of a second pipeline pass
+            point_estimates = predictions.mean(axis=0)
+
+        return [{
+            'lower_bound': lower,
+            'upper_bound': upper,
+            'prediction': prediction
+        } for lower, upper, prediction in zip(lower_bounds.tolist(), upper_bounds.tolist(), point_estimates.tolist())]
+
+    def __preprocess(self, df):
+        # Every step before the regressor, exactly as self.model.predict runs them
+        return self.model[:-1].transform(df.copy())
+
+    def __predict_trees(self, processed_df):
+        if self.mode == 'flat':
+            return self.flat_forest.predict(processed_df)
+
+        estimators = self.model.named_steps['extratreesregressor'].estimators_
+
+        if self.mode == 'serial' or self.n_jobs == 1:
+            return Model.__predict_chunk(estimators, processed_df)
+
+        # Tree prediction releases the GIL, so chunks of the forest can be
+        # predicted concurrently on a thread pool created on first use
+        if self.executor is None:
+            with self.executor_lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.n_jobs, thread_name_prefix='predict')
+
+        chunks = np.array_split(np.arange(len(estimators)), self.n_jobs)
+        futures = [self.executor.submit(Model.__predict_chunk, [estimators[i] for i in chunk], processed_df)
+                   for chunk in chunks if len(chunk)]
+
+        return np.vstack([future.result() for future in futures])
+
+    @staticmethod
+    def __predict_chunk(estimators, processed_df):
+        return np.array([tree.predict(processed_df) for tree in estimators])
@@ -0,0 +1,18 @@
+def get_memory(pid='self'):
+    # Resident memory of a process split into the pages it shares with other
+    # processes (e.g. the master it was forked from) and its own, in bytes.
+    # Linux only, None elsewhere.
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f.read().splitlines()[1:])
+    except OSError:
+        return None
+
+    kilobytes = {name: int(value.split()[0]) * 1024 for name, value in fields.items()}
+    return {
+        'rss': kilobytes['Rss'],
+        'pss': kilobytes['Pss'],
+        'shared': kilobytes['Shared_Clean'] + kilobytes['Shared_Dirty'],
+        'private': kilobytes['Private_Clean'] + kilobytes['Private_Dirty']
+    }
+
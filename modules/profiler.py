@@ -0,0 +1,147 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+# Bounds of the sampler, so a forgotten run stops and a tiny interval cannot
+# starve the worker
+DEFAULT_INTERVAL = 0.005
+MIN_INTERVAL = 0.001
+DEFAULT_DURATION = 30
+MAX_DURATION = 600
+
+CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+
+def is_enabled():
+    # Off unless AVM_PROFILING is set, in which case the app registers its
+    # profiling hooks and endpoints at import
+    return os.environ.get('AVM_PROFILING', '0').lower() in ('1', 'true', 'yes')
+
+
+class RequestProfiler:
+    # cProfile of a single request. Only one request per process is profiled
+    # at a time, as the profiles would otherwise measure each other.
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        if not RequestProfiler.lock.acquire(blocking=False):
+            return False
+
+        self.profile.enable()
+        return True
+
+    def stop(self):
+        self.profile.disable()
+        RequestProfiler.lock.release()
+
+    def report(self, sort='cumulative', limit=50):
+        # Calls made on the threads a request fans out to are not traced, and
+        # show up as time spent waiting on their futures
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).strip_dirs().sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+
+class StackSampler:
+    # Samples the stacks of every thread in the process at a fixed interval,
+    # counted by stack in the collapsed format read by flamegraph.pl and
+    # speedscope. Nothing runs while it is stopped.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.interval = DEFAULT_INTERVAL
+        self.started = None
+        self.stopped = None
+        self.samples = 0
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=DEFAULT_INTERVAL, duration=DEFAULT_DURATION):
+        # False when already running. Stacks of the previous run are cleared.
+        with self.lock:
+            if self.is_running():
+                return False
+
+            self.stacks = Counter()
+            self.samples = 0
+            self.interval = max(interval, MIN_INTERVAL)
+            self.started = time.time()
+            self.stopped = None
+            self.stopping.clear()
+            self.thread = threading.Thread(
+                target=self.__run, args=(min(duration, MAX_DURATION),), name='stack-sampler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stopping.set()
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def collapsed(self):
+        # One line per stack, outermost frame first: a;b;c count
+        with self.lock:
+            stacks = list(self.stacks.items())
+
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks))
+
+    def get_status(self):
+        return {
+            'pid': os.getpid(),
+            'running': self.is_running(),
+            'interval': self.interval,
+            'started': self.started,
+            'stopped': self.stopped,
+            'samples': self.samples
+        }
+
+    def __run(self, duration):
+        own = threading.get_ident()
+        names = {}
+        deadline = time.perf_counter() + duration
+
+        while not self.stopping.wait(self.interval) and time.perf_counter() < deadline:
+            threads = {thread.ident: thread.name for thread in threading.enumerate()}
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    sampled.append(';'.join([threads.get(ident, str(ident))] + self.__walk(frame, names)))
+
+            with self.lock:
+                self.stacks.update(sampled)
+                self.samples += 1
+
+        self.stopped = time.time()
+
+    @staticmethod
+    def __walk(frame, names):
+        # Frame names, outermost first, cached by code object
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                module = frame.f_globals.get('__name__', os.path.basename(code.co_filename))
+                name = names[code] = f'{module}.{getattr(code, "co_qualname", code.co_name)}'
+            stack.append(name)
+            frame = frame.f_back
+
+        stack.reverse()
+        return stack
+
+
+sampler = StackSampler()
@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    # In-process LRU cache of serialised finder responses keyed on the endpoint,
+    # the snapped coordinates and the remaining query parameters
+    def __init__(self, max_size=1024, ttl=3600, precision=6):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.precision = precision
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def from_env():
+        max_size = int(os.environ.get('AVM_RESPONSE_CACHE_SIZE', 1024))
+        ttl = float(os.environ.get('AVM_RESPONSE_CACHE_TTL', 3600))
+        precision = int(os.environ.get('AVM_RESPONSE_CACHE_PRECISION', 6))
+        path = os.environ.get('AVM_RESPONSE_CACHE_PATH')
+
+        if path:
+            return SqliteResponseCache(path, max_size=max_size, ttl=ttl, precision=precision)
+
+        return ResponseCache(max_size=max_size, ttl=ttl, precision=precision)
+
+    def snap(self, lat, lon):
+        return round(lat, self.precision), round(lon, self.precision)
+
+    def get_or_compute(self, key, compute):
+        if not self.max_size:
+            return compute()
+
+        value = self._get(key)
+        if value is not None:
+            with self.lock:
+                self.hits += 1
+            return value
+
+        with self.lock:
+            self.misses += 1
+
+        value = compute()
+        self._set(key, value)
+
+        return value
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _size(self):
+        return len(self.entries)
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': self._size(),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0
+            }
+
+
+class SqliteResponseCache(ResponseCache):
+    # Same cache backed by a local sqlite file so that all workers on a box
+    # share their responses. Hit and miss counters stay per process.
+    def __init__(self, path, max_size=1024, ttl=3600, precision=6):
+        super().__init__(max_size=max_size, ttl=ttl, precision=precision)
+        self.path = path
+        self.local = threading.local()
+
+        # A forked worker must not reuse the connections of its parent
+        os.register_at_fork(after_in_child=self.__forget_connections)
+
+        with self.__connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL)''')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+
+    def __forget_connections(self):
+        self.local = threading.local()
+
+    def __connect(self):
+        # sqlite connections cannot be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    def _get(self, key):
+        key = json.dumps(key)
+        now = time.time()
+
+        with self.__connect() as connection:
+            row = connection.execute(
+                'SELECT value FROM responses WHERE key = ? AND expires_at >= ?', (key, now)).fetchone()
+            if row is None:
+                return None
+
+            connection.execute(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def _set(self, key, value):
+        now = time.time()
+
+        with self.__connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                               (json.dumps(key), value, now + self.ttl, now))
+            connection.execute('DELETE FROM responses WHERE expires_at < ?', (now,))
+
+            evicted = connection.execute('''DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)''', (self.max_size,)).rowcount
+
+        with self.lock:
+            self.evictions += max(evicted, 0)
+
+    def invalidate(self):
+        with self.__connect() as connection:
+            connection.execute('DELETE FROM responses')
+
+    def _size(self):
+        return self.__connect().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+# Coordinates are kept as float32 when it moves no point by more than this
+# many degrees (about a metre)
+COORDINATE_TOLERANCE = 1e-5
+
+# Strings become categoricals when they take at most this share of distinct values
+MAX_CATEGORY_RATIO = 0.5
+
+# float64 columns are checked for a lossless float32 form on their distinct
+# values, which is only worth doing for columns with few of them
+MAX_FLOAT_CHECK_VALUES = 100000
+
+
+def memory_usage(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def compact_column(column, coordinate=False):
+    dtype = column.dtype
+
+    if dtype == object or isinstance(dtype, pd.StringDtype):
+        if column.nunique() <= MAX_CATEGORY_RATIO * len(column):
+            return column.astype('category')
+        return column
+
+    if not isinstance(dtype, np.dtype):
+        return column
+
+    if dtype.kind in 'iu':
+        return pd.to_numeric(column, downcast='integer')
+
+    if dtype == np.float64:
+        values = column.to_numpy()
+        compacted = values.astype(np.float32)
+
+        if coordinate:
+            lossless = np.nanmax(np.abs(compacted - values), initial=0) <= COORDINATE_TOLERANCE
+        else:
+            # Every value reads back as the same decimal, e.g. 173.3 and not
+            # 173.3000030517578, so responses do not change
+            distinct = np.unique(values[~np.isnan(values)])
+            lossless = len(distinct) <= MAX_FLOAT_CHECK_VALUES and np.array_equal(
+                distinct.astype(np.float32).astype(str).astype(np.float64), distinct)
+
+        if lossless:
+            return pd.Series(compacted, index=column.index, name=column.name)
+
+    return column
+
+
+def compact(df, coordinates=()):
+    # Copy of df with categorical strings, the smallest integer types and
+    # float32 where it loses nothing, with its memory use before and after
+    before = memory_usage(df)
+
+    df = df.copy(deep=False)
+    for name in df.columns:
+        df[name] = compact_column(df[name], coordinate=name in coordinates)
+
+    return df, {'before': before, 'after': memory_usage(df)}
+
+
+def compact_indexed(df, lat_col, lon_col):
+    # compact for the frame behind a spatial index. The index keeps its own
+    # copy of the coordinates, so the frame may hold them at float32.
+    return compact(df, coordinates=[lat_col, lon_col])
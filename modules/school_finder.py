@@ -1,17 +1,24 @@
+import modules.schema as schema
+import modules.utils as utils
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import BallTree
+from modules.count_grid import CountGrid
+from modules.spatial_index import SpatialIndex
 
 
 class SchoolFinder:
     def __init__(self, reader, uprn_df):
         self.reader = reader
-        self.df = self.__load_data()
+        self.df = self.__load_data(uprn_df)
         self.df = self.__enrich_school_data(self.df, uprn_df)
-        self.df_rad = np.radians(self.df[['UPRN_LATITUDE', 'UPRN_LONGITUDE']])
-        self.tree = BallTree(self.df_rad, metric='haversine')
+        self.index = SpatialIndex(self.df[['UPRN_LATITUDE', 'UPRN_LONGITUDE']].to_numpy())
+        self.count_keys, self.count_masks = SchoolFinder.__build_count_masks(
+            self.df)
+        self.count_grid = CountGrid.from_env(self.index, self.count_masks)
 
-    def __load_data(self):
+        self.df, self.memory_usage = schema.compact_indexed(self.df, 'UPRN_LATITUDE', 'UPRN_LONGITUDE')
+
+    def __load_data(self, uprn_df):
         column_map = {
             'URN': 'URN',
             'EstablishmentName': 'NAME',
@@ -34,15 +41,14 @@ class SchoolFinder:
             'UPRN': 'UPRN'
         }
 
-        df = self.reader.load_file(
+        df = self.reader.load_csv(
             name='national_school_edubasealldata20230402',
-            type='csv',
-            load=lambda f: pd.read_csv(f, header=0, usecols=list(
-                column_map.keys()), encoding='ISO-8859-1', low_memory=False)
+            options={'header': 0, 'usecols': list(column_map.keys())},
+            # Only open schools with a London UPRN
+            keep=lambda chunk: (chunk['EstablishmentStatus (name)'] == 'Open') & chunk['UPRN'].isin(uprn_df.index)
         )
         df.rename(columns=column_map, inplace=True)
 
-        df = df[df['STATUS'] == 'Open']
         df['OFSTEDRATING'] = df['OFSTEDRATING'].apply(
             lambda x: SchoolFinder.__map_ofsted_rating(x))
         df = df.add_prefix('SCH_')
@@ -77,40 +83,51 @@ class SchoolFinder:
 
         return df
 
-    def get_schools_within_radius(self, central_point, radius, minor_group=None, ofsted_rating=None):
-        search_radius = radius / 6371e3
+    def get_fields(self):
+        return list(self.df.columns)
+
+    def get_count_fields(self):
+        return self.count_keys + ['SCH_ALL']
 
-        indices = self.tree.query_radius(np.radians(
-            np.array(central_point)).reshape(1, -1), r=search_radius)
-        nearby_schools = self.df.iloc[indices[0]]
+    def get_schools_within_radius(self, central_point, radius, minor_group=None, ofsted_rating=None, columns=None):
+        indices = self.index.query_radius([central_point], radius)[0]
 
         if minor_group is not None:
-            nearby_schools = nearby_schools[nearby_schools['SCH_MINORGROUP'].str.lower(
-            ) == minor_group.lower()]
+            indices = indices[(self.df['SCH_MINORGROUP'].iloc[indices].str.lower(
+            ) == minor_group.lower()).to_numpy()]
 
         if ofsted_rating is not None:
-            nearby_schools = nearby_schools[nearby_schools['SCH_OFSTEDRATING']
-                                            >= ofsted_rating]
+            indices = indices[(self.df['SCH_OFSTEDRATING'].iloc[indices]
+                               >= ofsted_rating).to_numpy()]
 
-        return nearby_schools
+        return utils.select(self.df, indices, columns)
 
-    def get_school_counts(self, central_point, radius):
-        all_nearby_schools = self.get_schools_within_radius(
-            central_point, radius)
-
-        conditions = {
-            'SCH_ACAD': all_nearby_schools['SCH_MINORGROUP'] == 'Academies',
-            'SCH_IND': all_nearby_schools['SCH_MINORGROUP'] == 'Independent schools',
-            'SCH_NURSERY': (all_nearby_schools['SCH_PHASE'] == 'Nursery') | (all_nearby_schools['SCH_NURSERY'] == 'Has Nursery Classes'),
-            'SCH_PRIMARY': all_nearby_schools['SCH_PHASE'].isin(['Primary', 'Middle deemed primary', 'All-through']),
-            'SCH_SECONDARY': all_nearby_schools['SCH_PHASE'].isin(['Secondary', 'Middle deemed secondary', 'All-through']),
-            'SCH_OUTSTANDING': all_nearby_schools['SCH_OFSTEDRATING'] >= 6,
-            'SCH_GOOD': all_nearby_schools['SCH_OFSTEDRATING'] >= 5,
-            'SCH_INADEQUATE': all_nearby_schools['SCH_OFSTEDRATING'] <= 3,
+    @staticmethod
+    def __count_conditions(df):
+        return {
+            'SCH_ACAD': df['SCH_MINORGROUP'] == 'Academies',
+            'SCH_IND': df['SCH_MINORGROUP'] == 'Independent schools',
+            'SCH_NURSERY': (df['SCH_PHASE'] == 'Nursery') | (df['SCH_NURSERY'] == 'Has Nursery Classes'),
+            'SCH_PRIMARY': df['SCH_PHASE'].isin(['Primary', 'Middle deemed primary', 'All-through']),
+            'SCH_SECONDARY': df['SCH_PHASE'].isin(['Secondary', 'Middle deemed secondary', 'All-through']),
+            'SCH_OUTSTANDING': df['SCH_OFSTEDRATING'] >= 6,
+            'SCH_GOOD': df['SCH_OFSTEDRATING'] >= 5,
+            'SCH_INADEQUATE': df['SCH_OFSTEDRATING'] <= 3,
         }
 
-        counts = {key: all_nearby_schools[cond].shape[0]
-                  for key, cond in conditions.items()}
-        counts['SCH_ALL'] = all_nearby_schools.shape[0]
+    @staticmethod
+    def __build_count_masks(df):
+        # Evaluate every condition once over all schools, so that counts can be
+        # taken over the tree indices without building pandas masks per query
+        conditions = SchoolFinder.__count_conditions(df)
+        return list(conditions.keys()), np.column_stack([cond.to_numpy(dtype=bool)
+                                                         for cond in conditions.values()])
+
+    def get_school_counts(self, central_point, radius):
+        return self.get_school_counts_batch([central_point], radius)
+
+    def get_school_counts_batch(self, central_points, radius):
+        counts = utils.count_within(
+            self.index, self.count_masks, central_points, radius, self.count_grid)
 
-        return pd.DataFrame(counts, index=[0])
+        return pd.DataFrame(counts, columns=self.count_keys + ['SCH_ALL'])
@@ -0,0 +1,119 @@
+import json
+
+import modules.utils as utils
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def encode_numbers(series):
+    return series.to_numpy().tolist()
+
+
+def encode_floats(series):
+    # NaN becomes null, as DataFrame.to_json does
+    values = series.to_numpy()
+    encoded = values.tolist()
+    for i in np.flatnonzero(np.isnan(values)):
+        encoded[i] = None
+    return encoded
+
+
+def encode_float32s(series):
+    # Shortest decimal that reads back as the same float32, e.g. 173.3 rather
+    # than 173.3000030517578
+    values = series.to_numpy()
+    encoded = values.astype(str).astype(np.float64).tolist()
+    for i in np.flatnonzero(np.isnan(values)):
+        encoded[i] = None
+    return encoded
+
+
+def encode_datetimes(series):
+    # Milliseconds since the epoch, as DataFrame.to_json does by default
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+
+    values = series.to_numpy()
+    encoded = values.astype('datetime64[ms]').astype(np.int64).tolist()
+    for i in np.flatnonzero(np.isnat(values)):
+        encoded[i] = None
+    return encoded
+
+
+def encode_objects(series):
+    values = series.to_numpy(dtype=object)
+    encoded = values.tolist()
+    for i in np.flatnonzero(pd.isna(values)):
+        encoded[i] = None
+    return encoded
+
+
+def encode_default(value):
+    # Fallback for scalars left in object columns
+    if isinstance(value, pd.Timestamp):
+        return value.value // 10 ** 6
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Type is not serialisable: {type(value).__name__}')
+
+
+def column_encoder(dtype):
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return encode_datetimes
+    if not isinstance(dtype, np.dtype):
+        return encode_objects
+    if dtype == np.float32:
+        return encode_float32s
+    if dtype.kind == 'f':
+        return encode_floats
+    if dtype.kind in 'biu':
+        return encode_numbers
+    if dtype.kind == 'M':
+        return encode_datetimes
+    return encode_objects
+
+
+class RecordSerializer:
+    # Turns DataFrames into records straight from their column arrays. The
+    # encoders are picked from the dtypes on every call, which costs less
+    # than keying a cache by the column layout.
+    def to_records(self, df):
+        columns = [column_encoder(column.dtype)(column) for _, column in df.items()]
+        names = list(df.columns)
+
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+    def serialize(self, df, mimetype=JSON_MIMETYPE):
+        with utils.Timer('serialize'):
+            return encode(self.to_records(df), mimetype)
+
+
+def encode(value, mimetype=JSON_MIMETYPE):
+    if mimetype in MSGPACK_MIMETYPES:
+        return msgpack.packb(value, default=encode_default)
+    if orjson is not None:
+        return orjson.dumps(value, default=encode_default)
+    return json.dumps(value, separators=(',', ':'), default=encode_default).encode('utf-8')
+
+
+def negotiate(accept_mimetypes):
+    # Pick the response format from a werkzeug Accept header, JSON unless the
+    # client prefers MessagePack and it is installed
+    offered = [JSON_MIMETYPE] + (list(MSGPACK_MIMETYPES) if msgpack is not None else [])
+    return accept_mimetypes.best_match(offered, default=JSON_MIMETYPE) or JSON_MIMETYPE
+
+
+serializer = RecordSerializer()
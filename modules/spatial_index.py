@@ -0,0 +1,69 @@
+import modules.utils as utils
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Mean radius of the Earth, as used by the haversine queries it replaces
+EARTH_RADIUS = 6371e3
+
+# Greater London with a margin of several kilometres beyond the largest search
+# radius, as (south, west), (north, east)
+LONDON_BOUNDS = ((51.2, -0.65), (51.8, 0.45))
+
+
+class SpatialIndex:
+    # Latitude and longitude points held as geocentric x, y, z metres on a
+    # sphere of the Earth's mean radius. The straight line (chord) distance
+    # between two points grows with their great circle distance, so a plain
+    # Euclidean KD tree answers radius and nearest neighbour queries in metres
+    # exactly, without the cost of a haversine BallTree.
+    def __init__(self, coordinates):
+        self.tree = cKDTree(SpatialIndex.to_metres(coordinates))
+
+    @property
+    def n(self):
+        return self.tree.n
+
+    @staticmethod
+    def to_metres(coordinates):
+        coordinates = np.radians(np.asarray(coordinates, dtype=float).reshape(-1, 2))
+        lat, lon = coordinates[:, 0], coordinates[:, 1]
+
+        return EARTH_RADIUS * np.column_stack([np.cos(lat) * np.cos(lon),
+                                               np.cos(lat) * np.sin(lon),
+                                               np.sin(lat)])
+
+    @staticmethod
+    def to_coordinates(points):
+        return np.column_stack([np.degrees(np.arcsin(np.clip(points[:, 2] / EARTH_RADIUS, -1, 1))),
+                                np.degrees(np.arctan2(points[:, 1], points[:, 0]))])
+
+    @staticmethod
+    def to_chord(distance):
+        return 2 * EARTH_RADIUS * np.sin(np.minimum(distance, np.pi * EARTH_RADIUS) / (2 * EARTH_RADIUS))
+
+    @staticmethod
+    def to_distance(chord):
+        return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / (2 * EARTH_RADIUS), 1))
+
+    def get_coordinates(self):
+        # Latitude and longitude of the indexed points, in row order
+        return SpatialIndex.to_coordinates(self.tree.data)
+
+    def query(self, central_points, k=1):
+        # Great circle distances in metres and row indices of the k closest
+        # points to each of the given points, closest first
+        points = SpatialIndex.to_metres(central_points)
+        with utils.Timer('tree_query'):
+            chords, indices = self.tree.query(points, k=k)
+
+        return (SpatialIndex.to_distance(chords).reshape(len(points), k),
+                np.asarray(indices).reshape(len(points), k))
+
+    def query_radius(self, central_points, radius):
+        # Row indices, in row order, of the points within radius metres of
+        # each of the given points. radius can also hold one value per point.
+        points = SpatialIndex.to_metres(central_points)
+        with utils.Timer('tree_query'):
+            within = self.tree.query_ball_point(points, r=SpatialIndex.to_chord(radius), return_sorted=True)
+
+        return [np.asarray(rows, dtype=np.intp) for rows in within]
@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import modules.metrics as metrics
+import modules.utils as utils
+
+
+class StartupLoader:
+    # Runs the start up stages on a thread pool as soon as the stages they
+    # depend on have finished. Each stage is called with the results of its
+    # dependencies and its result is available to the stages after it.
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or int(
+            os.environ.get('AVM_LOAD_WORKERS', 8))
+        self.stages = {}
+        self.timings = {}
+
+    def add(self, name, load, depends_on=()):
+        unknown = [dependency for dependency in depends_on if dependency not in self.stages]
+        if unknown:
+            raise ValueError(f'Unknown dependencies of {name}: {", ".join(unknown)}')
+
+        self.stages[name] = (load, tuple(depends_on))
+
+    def __run_stage(self, name):
+        load, depends_on = self.stages[name]
+
+        with utils.Timer() as t:
+            result = load({dependency: self.results[dependency] for dependency in depends_on})
+            self.timings[name] = t.elapsed()
+            t.log(f'Stage {name} finished')
+            metrics.registry.set_gauge('avm_startup_stage_seconds', self.timings[name], stage=name)
+
+        return result
+
+    def run(self, prefetch=None):
+        # prefetch is called with the executor before any stage runs, e.g. to
+        # start downloads the stages will wait for
+        self.results = {}
+        remaining = dict(self.stages)
+
+        with utils.Timer() as t, ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            if prefetch is not None:
+                prefetch(executor)
+
+            running = {}
+            while remaining or running:
+                ready = [name for name, (_, depends_on) in remaining.items()
+                         if all(dependency in self.results for dependency in depends_on)]
+                for name in ready:
+                    del remaining[name]
+                    running[executor.submit(self.__run_stage, name)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # Any failure aborts the start up
+                    self.results[name] = future.result()
+
+            self.timings['total'] = t.elapsed()
+            t.log(f'All {len(self.stages)} stages finished')
+
+        return self.results
@@ -1,14 +1,30 @@
+import modules.schema as schema
+import modules.utils as utils
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import BallTree
+from modules.count_grid import CountGrid
+from modules.spatial_index import LONDON_BOUNDS, SpatialIndex
 
 
 class TransportFinder:
+    type_map = {
+        'NPT_NearbyBusStops': ['BCT', 'BCS', 'BCQ'],
+        'NPT_NearbyTramMetroStops': ['PLT', 'TMU', 'MET'],
+        'NPT_NearbyRailStops': ['RSE', 'RLY'],
+    }
+
     def __init__(self, reader):
         self.reader = reader
         self.df = self.__load_data()
-        self.df_rad = np.radians(self.df[['NPT_Latitude', 'NPT_Longitude']])
-        self.tree = BallTree(self.df_rad, metric='haversine')
+        self.index = SpatialIndex(self.df[['NPT_Latitude', 'NPT_Longitude']].to_numpy())
+
+        # One boolean column per count so that counts can be taken over the
+        # tree indices without building pandas masks per query
+        self.count_masks = np.column_stack([self.df['NPT_StopType'].isin(types).to_numpy()
+                                            for types in TransportFinder.type_map.values()])
+        self.count_grid = CountGrid.from_env(self.index, self.count_masks)
+
+        self.df, self.memory_usage = schema.compact_indexed(self.df, 'NPT_Latitude', 'NPT_Longitude')
 
     def __load_data(self):
         columns = ['ATCOCode', 'CommonName', 'ShortCommonName',
@@ -16,47 +32,53 @@ class TransportFinder:
                    'Easting', 'Northing', 'StopType', 'BusStopType', 'CreationDateTime', 'ModificationDateTime', 'RevisionNumber', 'Modification', 'Status',
                    'ETRS89GD-Lat', 'ETRS89GD-Long']
 
-        df = self.reader.load_file(
+        dates = ['CreationDateTime', 'ModificationDateTime']
+        df = self.reader.load_csv(
             name='NaPTAN_stops_geodetic',
-            type='csv',
-            load=lambda f: pd.read_csv(f,  header=0, usecols=columns, parse_dates=[
-                                       'CreationDateTime', 'ModificationDateTime'], low_memory=False)
+            options={'header': 0, 'usecols': columns, 'encoding': 'utf-8', 'parse_dates': dates},
+            # Drop inactive stops and stops outside London
+            keep=TransportFinder.__keep
         )
+        # The parsers pick different resolutions, the responses hold milliseconds
+        df[dates] = df[dates].astype('datetime64[ms]')
         df.rename(columns={'ETRS89GD-Lat': 'Latitude',
                   'ETRS89GD-Long': 'Longitude'}, inplace=True)
 
-        # Drop inactive stops
-        df = df[df['Status'] == 'active']
-
         df = df.add_prefix('NPT_')
         df.set_index('NPT_ATCOCode', inplace=True)
 
         return df
 
-    def get_stops_within_radius(self, central_point, radius, types=None):
-        search_radius = radius / 6371e3
+    @staticmethod
+    def __keep(df):
+        (south, west), (north, east) = LONDON_BOUNDS
+        return ((df['Status'] == 'active') &
+                df['ETRS89GD-Lat'].between(south, north) & df['ETRS89GD-Long'].between(west, east))
+
+    def get_fields(self):
+        return list(self.df.columns)
+
+    def get_count_fields(self):
+        return list(TransportFinder.type_map.keys()) + ['NPT_NearbyStops']
 
-        indices = self.tree.query_radius(np.radians(
-            np.array(central_point)).reshape(1, -1), r=search_radius)
-        nearby_stops = self.df.iloc[indices[0]]
+    def get_stops_within_radius(self, central_point, radius, types=None, columns=None):
+        indices = self.index.query_radius([central_point], radius)[0]
 
         if types is not None:
-            nearby_stops = nearby_stops[nearby_stops['NPT_StopType'].isin(
-                types)]
+            indices = indices[self.df['NPT_StopType'].iloc[indices].isin(
+                types).to_numpy()]
 
-        return nearby_stops
+        return utils.select(self.df, indices, columns)
 
     def get_stop_counts(self, central_point, radius):
-        all_nearby_stops = self.get_stops_within_radius(central_point, radius)
+        return self.get_stop_counts_batch([central_point], radius)
 
-        type_map = {
-            'NPT_NearbyBusStops': ['BCT', 'BCS', 'BCQ'],
-            'NPT_NearbyTramMetroStops': ['PLT', 'TMU', 'MET'],
-            'NPT_NearbyRailStops': ['RSE', 'RLY'],
-        }
+    def get_stop_counts_batch(self, central_points, radius):
+        counts = utils.count_within(
+            self.index, self.count_masks, central_points, radius, self.count_grid)
 
-        counts = {key: all_nearby_stops[all_nearby_stops['NPT_StopType'].isin(
-            types)].shape[0] for key, types in type_map.items()}
+        counts = {key: counts[:, i]
+                  for i, key in enumerate(TransportFinder.type_map.keys())}
         counts['NPT_NearbyStops'] = sum(counts.values())
 
-        return pd.DataFrame(counts, index=[0])
+        return pd.DataFrame(counts)
@@ -0,0 +1,12 @@
+import modules.schema as schema
+from modules.kd_tree_finder import KDTreeFinder
+
+
+class UPRNIndex(KDTreeFinder):
+    # Shared nearest UPRN lookup, only holding the coordinates and the area
+    # codes used to resolve LSOA and MSOA level attributes at query time
+    def __init__(self, onsud_df):
+        super().__init__(onsud_df[['UPRN_LATITUDE', 'UPRN_LONGITUDE', 'CPO_LSOA', 'CPO_MSOA']],
+                         'UPRN_LATITUDE', 'UPRN_LONGITUDE')
+
+        self.df, self.memory_usage = schema.compact_indexed(self.df, 'UPRN_LATITUDE', 'UPRN_LONGITUDE')
@@ -1,24 +1,80 @@
+import math
 import time
 
+import modules.metrics as metrics
+import numpy as np
+
 
 def format_ratio(dividend, divisor):
     return '%.4f' % (dividend * 100 / divisor) + '%'
 
 
+def count_by_point(indices, masks):
+    # Count, for each query point, the matched rows flagged in each mask column.
+    # indices is the per point array of row indices returned by a radius query
+    lengths = np.fromiter((len(i) for i in indices), dtype=np.intp, count=len(indices))
+    rows = np.concatenate(indices).astype(np.intp) if len(indices) else np.empty(0, dtype=np.intp)
+    point_ids = np.repeat(np.arange(len(indices)), lengths)
+
+    return np.column_stack([np.bincount(point_ids[masks[rows, i]], minlength=len(indices))
+                            for i in range(masks.shape[1])])
+
+
+def count_within(index, masks, central_points, radius, grid=None):
+    # Per point counts of the rows within radius flagged in each mask column,
+    # with the total in the last column, from the count grid when there is one
+    if grid is not None:
+        with Timer('count_grid'):
+            return grid.count(central_points, radius)
+
+    indices = index.query_radius(central_points, radius)
+    return np.column_stack([count_by_point(indices, masks),
+                            np.fromiter((len(i) for i in indices), dtype=np.int64, count=len(indices))])
+
+
+def finite_float(value):
+    # float() that also rejects nan and inf, which every spatial query would
+    # otherwise match or scan in full
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f'Not a finite number: {value}')
+    return number
+
+
+def split_fields(fields):
+    # Comma separated list of field names, as given in a query string
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
+def select(df, rows, columns=None):
+    # Slice the rows and, when given, only the requested columns in one step
+    with Timer('slice'):
+        if columns is None:
+            return df.iloc[rows]
+
+        return df.iloc[rows, df.columns.get_indexer(columns)]
+
+
 class Timer:
-    def __init__(self):
+    # Timers given a stage also record their elapsed time into the stage
+    # histograms served on /metrics
+    def __init__(self, stage=None):
+        self.stage = stage
         self.start_time = None
 
     def start(self):
         self.start_time = time.perf_counter()
 
+    def elapsed(self):
+        return time.perf_counter() - (self.start_time or 0)
+
     def log(self, message):
-        elapsed_time = time.perf_counter() - (self.start_time or 0)
-        print(f'=== {message} ({elapsed_time:0.4f}s) ===')
+        print(f'=== {message} ({self.elapsed():0.4f}s) ===')
 
     def __enter__(self):
         self.start()
         return self
 
     def __exit__(self, type, value, traceback):
-        pass
+        if self.stage is not None:
+            metrics.registry.observe(self.stage, self.elapsed())
@@ -0,0 +1,31 @@
+import pytest
+from benchmarks.s3_server import S3Server
+from benchmarks.synthetic import make_datasets
+
+
+@pytest.fixture(scope='session')
+def datasets():
+    # Objects of every dataset and the model at the small synthetic scale
+    return make_datasets('small', seed=0)
+
+
+@pytest.fixture(scope='session')
+def client(datasets, tmp_path_factory):
+    # Test client of the app, which loads its first generation at import,
+    # reading the datasets from the local stand-in for S3
+    directory = tmp_path_factory.mktemp('bucket')
+    for key, data in datasets.items():
+        (directory / key).write_bytes(data)
+
+    s3 = S3Server(str(directory)).start()
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv('AVM_S3_ENDPOINT_URL', s3.endpoint_url)
+        env.setenv('AVM_CACHE_DIR', str(tmp_path_factory.mktemp('cache')))
+        env.setenv('AVM_BUNDLE_DIR', '')
+        env.setenv('AWS_ACCESS_KEY_ID', 'test')
+        env.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+
+        import app
+        yield app.app.test_client()
+
+    s3.shutdown()
@@ -0,0 +1,51 @@
+import hashlib
+import io
+
+import numpy as np
+from botocore.exceptions import ClientError, EndpointConnectionError
+from modules.data_reader import S3DataReader
+from modules.file_cache import LocalFileCache
+from modules.spatial_index import EARTH_RADIUS
+
+
+class StubS3:
+    # The head_object and get_object calls of the boto3 client, with ETags
+    # and conditional requests as S3 answers them
+    def __init__(self, objects):
+        self.objects = dict(objects)
+        self.reachable = True
+        self.gets = 0
+
+    def etag(self, key):
+        return f'"{hashlib.md5(self.objects[key]).hexdigest()}"'
+
+    def head_object(self, Bucket, Key, IfNoneMatch=None):
+        self.check(Key)
+        if IfNoneMatch == self.etag(Key):
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'HeadObject')
+        return {'ETag': self.etag(Key)}
+
+    def get_object(self, Bucket, Key, IfMatch=None):
+        self.check(Key)
+        if IfMatch is not None and IfMatch != self.etag(Key):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': ''}}, 'GetObject')
+        self.gets += 1
+        return {'ETag': self.etag(Key), 'Body': io.BytesIO(self.objects[Key])}
+
+    def check(self, key):
+        if not self.reachable:
+            raise EndpointConnectionError(endpoint_url='http://s3.stub')
+        if key not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+
+
+def make_reader(s3, directory, offline=False):
+    return S3DataReader(s3=s3, cache=LocalFileCache(str(directory)), offline=offline, stream=False)
+
+
+def haversine(central_point, coordinates):
+    # Great circle distances in metres from one point to every coordinate
+    lat, lon = np.radians(central_point)
+    lats, lons = np.radians(np.asarray(coordinates, dtype=float)).T
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
@@ -0,0 +1,55 @@
+import modules.utils as utils
+import pytest
+
+INVALID = {'error': 'Invalid parameters'}
+
+
+@pytest.mark.parametrize('value', ['nan', 'inf', '-inf', 'Infinity'])
+def test_non_finite_coordinates_are_rejected(client, value):
+    for path in ('/epc?top=5', '/transports?radius=800', '/schools?radius=800',
+                 '/greenspace?top=5', '/imd?top=5', '/features?'):
+        assert client.get(f'{path}&lat={value}&lon=-0.1').get_json() == INVALID
+        assert client.get(f'{path}&lat=51.5&lon={value}').get_json() == INVALID
+
+
+def test_finite_coordinates_are_served(client):
+    assert client.get('/features?lat=51.5&lon=-0.1').status_code == 200
+
+
+@pytest.mark.parametrize('lat', ['nan', 'inf', 1e400, 10 ** 400])
+def test_batch_rejects_non_finite_coordinates(client, lat):
+    response = client.post('/features/batch', json={'points': [{'lat': 51.5, 'lon': -0.1}, {'lat': lat, 'lon': -0.1}]})
+
+    assert response.status_code == 500
+    assert response.get_json() == INVALID
+
+
+def test_batch_rejects_too_many_points(client, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'MAX_BATCH_POINTS', 2)
+    points = [{'lat': 51.5, 'lon': -0.1}] * 3
+
+    assert client.post('/features/batch', json={'points': points[:2]}).status_code == 200
+    assert client.post('/features/batch', json={'points': points}).get_json() == INVALID
+
+
+def test_finite_float():
+    assert utils.finite_float('51.5') == 51.5
+    with pytest.raises(ValueError):
+        utils.finite_float('nan')
+
+
+def test_empty_fields_return_every_field(client):
+    full = client.get('/schools?lat=51.5&lon=-0.1&radius=5000').get_json()
+
+    assert full and all(record for record in full)
+    assert client.get('/schools?lat=51.5&lon=-0.1&radius=5000&fields=').get_json() == full
+    assert client.get('/schools?lat=51.5&lon=-0.1&radius=5000&fields=,').get_json() == full
+
+
+def test_batch_empty_fields_return_every_field(client):
+    points = [{'lat': 51.5, 'lon': -0.1}]
+    full = client.post('/features/batch', json={'points': points}).get_json()
+
+    assert client.post('/features/batch', json={'points': points, 'fields': []}).get_json() == full
+    assert client.post('/features/batch', json={'points': points, 'fields': ''}).get_json() == full
@@ -0,0 +1,76 @@
+import pickle
+
+import modules.bundle as bundle
+import numpy as np
+from modules.attribute_finder import LocationAttributeFinder
+from modules.count_grid import CountGrid
+from modules.response_cache import ResponseCache
+from modules.spatial_index import SpatialIndex
+from tests.stubs import StubS3, make_reader
+
+
+def make_grid():
+    rng = np.random.default_rng(0)
+    coordinates = np.column_stack([rng.uniform(51.4, 51.6, 3000), rng.uniform(-0.3, 0.1, 3000)])
+    masks = rng.random((len(coordinates), 2)) < 0.3
+    return CountGrid(SpatialIndex(coordinates), masks, cell_size=100)
+
+
+def test_count_grid_round_trips_through_a_bundle(tmp_path):
+    grid = make_grid()
+    points = [[51.5, -0.1], [51.45, 0.05]]
+    expected = grid.count(points, 800)
+
+    bundle.write_bundle(str(tmp_path / 'bundle'), grid)
+    loaded = bundle.read_bundle(str(tmp_path / 'bundle'))
+
+    assert isinstance(loaded, CountGrid)
+    assert len(loaded.stencils) == 0
+    assert np.array_equal(loaded.count(points, 800), expected)
+
+
+def test_count_grid_pickles_without_its_stencils():
+    grid = make_grid()
+    grid.count([[51.5, -0.1]], 800)
+
+    loaded = pickle.loads(pickle.dumps(grid))
+
+    assert len(loaded.stencils) == 0
+    assert np.array_equal(loaded.count([[51.5, -0.1]], 800), grid.count([[51.5, -0.1]], 800))
+
+
+def write_finder_bundle(s3, tmp_path):
+    reader = make_reader(s3, tmp_path / 'cache')
+    finder = LocationAttributeFinder(reader, bundle_dir='', cache=ResponseCache(max_size=0))
+    bundle.write_bundle(str(tmp_path / 'bundle'), finder, reader.get_etags(LocationAttributeFinder.datasets))
+    return finder
+
+
+def open_finder(s3, tmp_path):
+    return LocationAttributeFinder(make_reader(s3, tmp_path / 'cache'), bundle_dir=str(tmp_path / 'bundle'),
+                                   cache=ResponseCache(max_size=0), version='current')
+
+
+def test_finder_opens_a_bundle_of_the_current_datasets(tmp_path, datasets):
+    s3 = StubS3(datasets)
+    built = write_finder_bundle(s3, tmp_path)
+    gets = s3.gets
+
+    finder = open_finder(s3, tmp_path)
+
+    assert s3.gets == gets
+    assert finder.version != 'current'
+    assert finder.find_all(51.5, -0.1, 800) == built.find_all(51.5, -0.1, 800)
+
+
+def test_finder_refuses_a_bundle_whose_datasets_changed(tmp_path, datasets):
+    s3 = StubS3(datasets)
+    write_finder_bundle(s3, tmp_path)
+    gets = s3.gets
+    # Same stops, new ETag
+    s3.objects['NaPTAN_stops_geodetic.csv'] += b'\n'
+
+    finder = open_finder(s3, tmp_path)
+
+    assert s3.gets == gets + 1
+    assert finder.version == 'current'
@@ -0,0 +1,40 @@
+import modules.count_grid as count_grid
+import modules.utils as utils
+import numpy as np
+from modules.count_grid import CountGrid
+from modules.spatial_index import SpatialIndex
+
+
+def make_grid(cell_size=50):
+    rng = np.random.default_rng(0)
+    coordinates = np.column_stack([rng.uniform(51.4, 51.6, 5000), rng.uniform(-0.3, 0.1, 5000)])
+    index = SpatialIndex(coordinates)
+    masks = rng.random((len(coordinates), 2)) < 0.3
+    return CountGrid(index, masks, cell_size=cell_size), index, masks
+
+
+def test_counts_match_radius_queries():
+    grid, index, masks = make_grid()
+    points = np.column_stack([np.linspace(51.45, 51.55, 20), np.linspace(-0.25, 0.05, 20)])
+
+    for radius in (200, 800, 1600):
+        assert np.array_equal(grid.count(points, radius), utils.count_within(index, masks, points, radius))
+
+
+def test_radius_beyond_the_grid_skips_the_stencil():
+    grid, index, masks = make_grid()
+    points = np.array([[51.5, -0.1]])
+
+    counts = grid.count(points, 200000)
+
+    assert np.array_equal(counts, utils.count_within(index, masks, points, 200000))
+    assert 200000 not in grid.stencils
+
+
+def test_stencils_are_bounded():
+    grid, _, _ = make_grid()
+
+    for radius in range(100, 100 + 10 * (count_grid.MAX_STENCILS + 5), 10):
+        grid.count([[51.5, -0.1]], radius)
+
+    assert len(grid.stencils) == count_grid.MAX_STENCILS
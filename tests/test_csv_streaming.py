@@ -0,0 +1,49 @@
+import io
+
+import pandas as pd
+import pytest
+from modules.data_reader import S3DataReader
+from modules.file_cache import LocalFileCache
+from modules.school_finder import SchoolFinder
+from modules.transport_finder import TransportFinder
+from tests.stubs import StubS3, make_reader
+
+
+def make_streaming_reader(s3, directory):
+    return S3DataReader(s3=s3, cache=LocalFileCache(str(directory)), offline=False, stream=True)
+
+
+CSV = b'name,kind,value\n' + b''.join(f'row{i},{"ab"[i % 2]},{i * 0.5}\n'.encode() for i in range(50))
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 100000])
+def test_streamed_and_buffered_csv_give_the_same_frame(tmp_path, chunksize):
+    s3 = StubS3({'a.csv': CSV})
+    keep = lambda df: df['kind'] == 'a'
+
+    buffered = make_reader(s3, tmp_path / 'buffered').load_csv('a', options={'header': 0}, keep=keep)
+    streamed = make_streaming_reader(s3, tmp_path / 'streamed').load_csv(
+        'a', options={'header': 0}, keep=keep, chunksize=chunksize)
+
+    pd.testing.assert_frame_equal(streamed, buffered.reset_index(drop=True))
+    assert len(streamed) == 25
+
+
+def test_streamed_csv_is_never_written_to_the_cache(tmp_path):
+    reader = make_streaming_reader(StubS3({'a.csv': CSV}), tmp_path)
+
+    reader.load_csv('a', options={'header': 0})
+
+    assert reader.cache.get_ref(reader.bucket_name, 'a.csv') is None
+
+
+def test_streamed_finders_match_buffered_ones(tmp_path, datasets):
+    s3 = StubS3(datasets)
+    onsud = pd.read_parquet(io.BytesIO(datasets['london_onsud_uprn.parquet']))
+
+    for finder in (lambda reader: TransportFinder(reader), lambda reader: SchoolFinder(reader, onsud)):
+        buffered = finder(make_reader(s3, tmp_path / 'buffered')).df
+        streamed = finder(make_streaming_reader(s3, tmp_path / 'streamed')).df
+
+        assert len(streamed) > 0
+        pd.testing.assert_frame_equal(streamed.reset_index(drop=True), buffered.reset_index(drop=True))
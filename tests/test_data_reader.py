@@ -0,0 +1,144 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pandas as pd
+import pytest
+from benchmarks.s3_server import S3Server
+from botocore.exceptions import ClientError, EndpointConnectionError
+from modules.attribute_finder import LocationAttributeFinder
+from modules.response_cache import ResponseCache
+from tests.stubs import StubS3, make_reader
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_cold_fetch_downloads_the_object(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+
+    path = make_reader(s3, tmp_path).fetch('a.csv')
+
+    assert read(path) == b'x,y\n1,2\n'
+    assert s3.gets == 1
+
+
+def test_warm_fetch_is_served_from_the_cache(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+    cold = make_reader(s3, tmp_path).fetch('a.csv')
+
+    warm = make_reader(s3, tmp_path).fetch('a.csv')
+
+    assert warm == cold
+    assert s3.gets == 1
+
+
+def test_changed_object_is_downloaded_again(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+    make_reader(s3, tmp_path).fetch('a.csv')
+    s3.objects['a.csv'] = b'x,y\n3,4\n'
+
+    path = make_reader(s3, tmp_path).fetch('a.csv')
+
+    assert read(path) == b'x,y\n3,4\n'
+    assert s3.gets == 2
+
+
+def test_offline_fetch_serves_the_cached_snapshot(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+    make_reader(s3, tmp_path).fetch('a.csv')
+    s3.reachable = False
+
+    path = make_reader(s3, tmp_path, offline=True).fetch('a.csv')
+
+    assert read(path) == b'x,y\n1,2\n'
+
+
+def test_offline_fetch_of_an_uncached_object_fails(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        make_reader(StubS3({}), tmp_path, offline=True).fetch('a.csv')
+
+
+def test_unreachable_s3_falls_back_to_the_cache(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+    make_reader(s3, tmp_path).fetch('a.csv')
+    s3.reachable = False
+
+    path = make_reader(s3, tmp_path).fetch('a.csv')
+
+    assert read(path) == b'x,y\n1,2\n'
+
+
+def test_unreachable_s3_without_a_cached_copy_fails(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+    s3.reachable = False
+
+    with pytest.raises(EndpointConnectionError):
+        make_reader(s3, tmp_path).fetch('a.csv')
+
+
+def test_real_client_against_the_local_s3(tmp_path):
+    # The stub cannot catch arguments botocore rejects, so the same fetch is
+    # made through boto3 against the stand-in
+    (tmp_path / 'bucket').mkdir()
+    (tmp_path / 'bucket' / 'a.csv').write_bytes(b'x,y\n1,2\n')
+    server = S3Server(str(tmp_path / 'bucket')).start()
+    try:
+        s3 = boto3.client('s3', endpoint_url=server.endpoint_url, region_name='eu-west-2',
+                          aws_access_key_id='test', aws_secret_access_key='test')
+        cold = make_reader(s3, tmp_path / 'cache').fetch('a.csv')
+        warm = make_reader(s3, tmp_path / 'cache').fetch('a.csv')
+    finally:
+        server.shutdown()
+
+    assert read(cold) == b'x,y\n1,2\n'
+    assert warm == cold
+
+
+def test_failed_start_up_does_not_leave_stale_prefetches(tmp_path, datasets):
+    objects = dict(datasets)
+    del objects['london_onsud_uprn.parquet']
+    s3 = StubS3(objects)
+    reader = make_reader(s3, tmp_path)
+
+    # Every stage needing the ONS UPRN directory fails before reading the
+    # datasets prefetched for it
+    with pytest.raises(ClientError):
+        LocationAttributeFinder(reader, bundle_dir='', cache=ResponseCache(max_size=0))
+    assert reader.pending == {}
+
+    s3.objects['london_epc.parquet'] = b'changed'
+    assert read(reader.fetch('london_epc.parquet')) == b'changed'
+
+
+def evict_source(reader, key):
+    os.remove(reader.cache.object_path(reader.bucket_name, key, reader.cache.get_etag(reader.bucket_name, key)))
+
+
+def test_converted_copy_is_read_without_the_evicted_source(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+    first = make_reader(s3, tmp_path).load_file('a', 'csv', options={'header': 0})
+    evict_source(make_reader(s3, tmp_path), 'a.csv')
+
+    reader = make_reader(s3, tmp_path)
+    with ThreadPoolExecutor() as executor:
+        reader.prefetch(['a.csv'], executor)
+    df = reader.load_file('a', 'csv', options={'header': 0})
+
+    pd.testing.assert_frame_equal(df, first)
+    assert reader.pending == {}
+    assert s3.gets == 1
+
+
+def test_converted_copy_of_a_changed_object_is_not_used(tmp_path):
+    s3 = StubS3({'a.csv': b'x,y\n1,2\n'})
+    make_reader(s3, tmp_path).load_file('a', 'csv', options={'header': 0})
+    evict_source(make_reader(s3, tmp_path), 'a.csv')
+    s3.objects['a.csv'] = b'x,y\n3,4\n'
+
+    df = make_reader(s3, tmp_path).load_file('a', 'csv', options={'header': 0})
+
+    assert df.to_dict('records') == [{'x': 3, 'y': 4}]
+    assert s3.gets == 2
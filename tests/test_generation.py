@@ -0,0 +1,118 @@
+import threading
+import time
+
+import modules.generation as generation
+import pytest
+from modules.file_cache import LocalFileCache
+from modules.generation import GenerationManager
+
+
+class StubFinder:
+    def __init__(self, version):
+        self.version = version
+
+
+class StubReader:
+    def __init__(self, directory):
+        self.cache = LocalFileCache(str(directory))
+        self.etags = {'a.csv': '"1"'}
+
+    def get_etags(self, keys):
+        return {key: self.etags.get(key) for key in keys}
+
+
+class Builder:
+    # Build function of the manager, which can be held until released and
+    # made to fail
+    def __init__(self):
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = False
+        self.versions = []
+
+    def __call__(self, version, previous):
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError('build failed')
+        self.versions.append(version)
+        return {'model': object(), 'finder': StubFinder(version)}, {}
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def reader(tmp_path):
+    return StubReader(tmp_path)
+
+
+def test_reload_swaps_in_the_next_generation(reader):
+    build = Builder()
+    manager = GenerationManager(reader, build, ['a.csv'], interval=0)
+    first = manager.current
+    reader.etags['a.csv'] = '"2"'
+
+    assert manager.reload()
+    wait_until(lambda: manager.current.id == 2)
+
+    assert manager.current.finder.version != first.finder.version
+    assert manager.current.etags == {'a.csv': '"2"'}
+    # Requests holding the previous generation keep it whole
+    assert first.id == 1 and first.etags == {'a.csv': '"1"'}
+
+
+def test_reload_is_refused_while_one_is_building(reader):
+    build = Builder()
+    manager = GenerationManager(reader, build, ['a.csv'], interval=0)
+    build.release.clear()
+
+    assert manager.reload()
+    assert not manager.reload()
+    assert not manager.request_reload()
+    assert manager.get_status()['reloading']
+
+    build.release.set()
+    wait_until(lambda: not manager.get_status()['reloading'])
+    assert manager.current.id == 2
+    assert manager.reload()
+
+
+def test_failed_reload_keeps_the_current_generation(reader):
+    build = Builder()
+    manager = GenerationManager(reader, build, ['a.csv'], interval=0)
+    build.fail = True
+
+    manager.reload()
+    wait_until(lambda: not manager.get_status()['reloading'])
+
+    assert manager.current.id == 1
+    assert 'build failed' in manager.get_status()['last_error']
+
+
+def test_requested_reload_reaches_every_manager_sharing_the_marker(reader, monkeypatch):
+    monkeypatch.setattr(generation, 'MARKER_INTERVAL', 0.05)
+    managers = [GenerationManager(reader, Builder(), ['a.csv'], interval=0) for _ in range(3)]
+    for manager in managers:
+        manager.watch()
+
+    assert managers[0].request_reload()
+
+    wait_until(lambda: all(manager.current.id == 2 for manager in managers))
+    time.sleep(0.2)
+    assert [manager.current.id for manager in managers] == [2, 2, 2]
+
+
+def test_reload_endpoint_answers_409_while_reloading(client, monkeypatch):
+    import app
+    monkeypatch.setenv('AVM_ADMIN_TOKEN', 'secret')
+    monkeypatch.setattr(app.generations, 'reloading', threading.Thread())
+
+    response = client.post('/reload', headers={'Authorization': 'Bearer secret'})
+
+    assert response.status_code == 409
+    assert client.post('/reload').status_code == 403
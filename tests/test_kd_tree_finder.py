@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from modules.kd_tree_finder import KDTreeFinder
+from tests.stubs import haversine
+
+# Grid laid out symmetrically about the Greenwich meridian, so that points on
+# it are exactly as far from a query on the meridian as their mirror images
+SPACING = 0.001
+
+
+def make_finder(seed, max_rows=4):
+    rng = np.random.default_rng(seed)
+    lats = 51.5 + SPACING * np.arange(-10, 11)
+    lons = SPACING * np.arange(-10, 11)
+    points = np.array([(lat, lon) for lat in lats for lon in lons])
+    # Several rows at most points, as with flats sharing a UPRN coordinate
+    rows = np.repeat(points, rng.integers(1, max_rows + 1, len(points)), axis=0)
+    rows = rows[rng.permutation(len(rows))]
+    df = pd.DataFrame({'lat': rows[:, 0], 'lon': rows[:, 1], 'id': np.arange(len(rows))})
+    return KDTreeFinder(df, 'lat', 'lon'), df
+
+
+def brute_force(df, central_point, top_n):
+    # Every row within the distance of the top_n closest row
+    distances = haversine(central_point, df[['lat', 'lon']].to_numpy())
+    last = np.sort(distances)[top_n - 1]
+    return set(np.flatnonzero(distances <= last + 1e-6)), distances
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('top_n', [2, 5, 12])
+def test_ties_match_brute_force(seed, top_n):
+    finder, df = make_finder(seed)
+    central_points = [(51.5 + SPACING * i / 2, 0.0) for i in range(-6, 7)]
+
+    for central_point, rows in zip(central_points, finder.query_closest(central_points, top_n, max_ties=1000)):
+        expected, distances = brute_force(df, central_point, top_n)
+
+        assert set(rows) == expected
+        assert len(rows) == len(expected)
+        # Closest first
+        assert np.all(np.diff(distances[rows]) >= -1e-6)
+
+
+def test_ties_are_capped():
+    finder, df = make_finder(0, max_rows=50)
+
+    rows = finder.query_closest([(51.5, 0.0)], top_n=5, max_ties=3)[0]
+    expected, _ = brute_force(df, (51.5, 0.0), 5)
+
+    assert len(rows) == 8
+    assert set(rows) <= expected
+
+
+def test_single_closest_match_is_never_extended():
+    finder, df = make_finder(0)
+
+    rows = finder.query_closest([(51.5, 0.0)], top_n=1)[0]
+
+    assert len(rows) == 1
+    assert (df['lat'].iloc[rows[0]], df['lon'].iloc[rows[0]]) == (51.5, 0.0)
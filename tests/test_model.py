@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic import train_model, training_frame
+from modules.model import PREDICT_MODES, Model
+
+
+class StubReader:
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, key):
+        return self.path
+
+
+@pytest.fixture(scope='module')
+def model_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp('model') / Model.model_name
+    path.write_bytes(train_model(np.random.default_rng(0), samples=500, n_estimators=20, max_depth=8))
+    return str(path)
+
+
+@pytest.fixture(scope='module')
+def records():
+    return training_frame(np.random.default_rng(1), 25)
+
+
+def predict_per_tree(pipeline, df):
+    # The three cleaning steps and per-tree loop that predictions were made
+    # with before predict_batch, one record at a time
+    processed_df = df.copy()
+    preprocessing = pipeline.named_steps['pipeline']
+    processed_df = preprocessing.named_steps['invalidvaluecleaner'].transform(processed_df)
+    processed_df = preprocessing.named_steps['stringcleaner'].transform(processed_df)
+    processed_df = preprocessing.named_steps['columntransformer'].transform(processed_df)
+
+    predictions = np.array([tree.predict(processed_df)
+                            for tree in pipeline.named_steps['extratreesregressor'].estimators_])
+
+    return {
+        'lower_bound': np.percentile(predictions, 10),
+        'upper_bound': np.percentile(predictions, 90),
+        'prediction': pipeline.predict(df).tolist()[0]
+    }
+
+
+@pytest.mark.parametrize('mode', PREDICT_MODES)
+def test_predict_batch_matches_the_per_tree_path(model_path, records, mode):
+    model = Model(StubReader(model_path), mode=mode, n_jobs=3)
+
+    results = model.predict_batch(records)
+
+    assert len(results) == len(records)
+    for i, result in enumerate(results):
+        expected = predict_per_tree(model.model, records.iloc[[i]])
+        for name in ('lower_bound', 'upper_bound', 'prediction'):
+            assert result[name] == pytest.approx(expected[name], rel=1e-9)
+
+
+@pytest.mark.parametrize('mode', PREDICT_MODES)
+def test_predictions_match_the_pipeline(model_path, records, mode):
+    model = Model(StubReader(model_path), mode=mode, n_jobs=3)
+
+    predictions = [result['prediction'] for result in model.predict_batch(records)]
+
+    np.testing.assert_allclose(predictions, model.model.predict(records), rtol=1e-9)
+    assert model.predict(records.iloc[[0]]) == model.predict_batch(records.iloc[[0]])[0]
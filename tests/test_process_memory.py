@@ -0,0 +1,64 @@
+import gc
+import json
+import os
+
+import numpy as np
+import pytest
+from modules.attribute_finder import LocationAttributeFinder
+from modules.process_memory import get_memory
+from modules.response_cache import ResponseCache
+from tests.stubs import StubS3, make_reader
+
+WORKERS = 2
+REQUESTS = 50
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/smaps_rollup'),
+                                reason='needs /proc/self/smaps_rollup')
+
+
+def serve(finder, seed):
+    # The location lookups around London, enough to touch every finder the
+    # way real traffic does
+    rng = np.random.default_rng(seed)
+    for lat, lon in np.column_stack([rng.uniform(51.35, 51.65, REQUESTS), rng.uniform(-0.45, 0.2, REQUESTS)]):
+        finder.find_all(lat, lon, 800)
+        finder.find_epc(lat, lon, 5)
+
+
+def test_forked_workers_share_the_preloaded_finder(tmp_path, datasets):
+    # Loaded once and frozen before the fork, as gunicorn.conf.py does
+    finder = LocationAttributeFinder(make_reader(StubS3(datasets), tmp_path), bundle_dir='',
+                                     cache=ResponseCache(max_size=0))
+    gc.collect()
+    gc.freeze()
+
+    try:
+        children = []
+        for worker in range(WORKERS):
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # The child never returns into pytest, whatever happens
+                try:
+                    os.close(read_end)
+                    serve(finder, worker)
+                    # A full collection, as a long running worker eventually does
+                    gc.collect()
+                    with os.fdopen(write_end, 'w') as f:
+                        json.dump(get_memory(), f)
+                finally:
+                    os._exit(0)
+
+            os.close(write_end)
+            children.append((pid, read_end))
+
+        reports = []
+        for pid, read_end in children:
+            with os.fdopen(read_end) as f:
+                reports.append(json.load(f))
+            os.waitpid(pid, 0)
+    finally:
+        gc.unfreeze()
+
+    for report in reports:
+        assert report['private'] < report['shared'] / 4
@@ -0,0 +1,62 @@
+import pytest
+from modules.attribute_finder import LocationAttributeFinder
+from modules.response_cache import ResponseCache, SqliteResponseCache
+from tests.stubs import StubS3, make_reader
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path):
+    if request.param == 'sqlite':
+        return SqliteResponseCache(str(tmp_path / 'responses.db'), max_size=2)
+    return ResponseCache(max_size=2)
+
+
+class Compute:
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_hit_returns_the_same_bytes(cache):
+    compute = Compute(b'[{"a":1}]')
+
+    first = cache.get_or_compute(('epc', 'v1', 51.5, -0.1), compute)
+    second = cache.get_or_compute(('epc', 'v1', 51.5, -0.1), compute)
+
+    assert first == second == b'[{"a":1}]'
+    assert compute.calls == 1
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_version_change_misses(cache):
+    cache.get_or_compute(('epc', 'v1', 51.5, -0.1), Compute(b'old'))
+
+    assert cache.get_or_compute(('epc', 'v2', 51.5, -0.1), Compute(b'new')) == b'new'
+    assert cache.get_stats()['misses'] == 2
+
+
+def test_least_recently_used_entry_is_evicted(cache):
+    for key in ('a', 'b', 'a', 'c'):
+        cache.get_or_compute((key,), Compute(key.encode()))
+
+    assert cache.get_stats()['evictions'] == 1
+    assert cache.get_or_compute(('a',), Compute(b'again')) == b'a'
+    assert cache.get_or_compute(('b',), Compute(b'again')) == b'again'
+
+
+def test_finder_responses_are_cached_per_version(tmp_path, datasets):
+    cache = ResponseCache(max_size=16)
+    finder = LocationAttributeFinder(make_reader(StubS3(datasets), tmp_path), bundle_dir='', cache=cache,
+                                     version='v1')
+
+    first = finder.find_epc(51.5, -0.1, 5)
+    assert finder.find_epc(51.5, -0.1, 5) is first
+
+    finder.version = 'v2'
+    recomputed = finder.find_epc(51.5, -0.1, 5)
+    assert recomputed is not first and recomputed == first
+    assert cache.get_stats()['hits'] == 1
@@ -0,0 +1,45 @@
+import http.client
+
+import pytest
+from benchmarks.s3_server import S3Server
+
+
+@pytest.fixture
+def server(tmp_path):
+    (tmp_path / 'bucket').mkdir()
+    (tmp_path / 'bucket' / 'a.csv').write_bytes(b'x,y\n1,2\n')
+    (tmp_path / 'secret.txt').write_bytes(b'secret')
+    server = S3Server(str(tmp_path / 'bucket')).start()
+    yield server
+    server.shutdown()
+
+
+def get(server, path):
+    host, port = server.server_address[:2]
+    connection = http.client.HTTPConnection(host, port, timeout=5)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def test_objects_are_served(server):
+    assert get(server, '/avm-area-data/a.csv') == (200, b'x,y\n1,2\n')
+
+
+@pytest.mark.parametrize('path', ['/avm-area-data/../secret.txt', '/avm-area-data/%2E%2E/secret.txt',
+                                  '/avm-area-data/..%2Fsecret.txt', '/../../secret.txt'])
+def test_paths_outside_the_directory_are_not_found(server, path):
+    status, body = get(server, path)
+
+    assert status == 404
+    assert b'secret' not in body
+
+
+def test_absolute_keys_are_not_found(server, tmp_path):
+    status, body = get(server, f'/avm-area-data/{tmp_path}/secret.txt')
+
+    assert status == 404
+    assert b'secret' not in body
@@ -0,0 +1,80 @@
+import io
+
+import modules.schema as schema
+import numpy as np
+import pandas as pd
+from modules.serializer import RecordSerializer
+
+
+def make_frame(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'lat': rng.uniform(51.3, 51.7, n),
+        'lon': rng.uniform(-0.5, 0.3, n),
+        'area': np.round(rng.uniform(20, 300, n), 1),
+        'ratio': rng.random(n),
+        'rooms': rng.integers(1, 10, n),
+        'kind': rng.choice(['flat', 'house', 'bungalow'], n).astype(object),
+        'name': np.array([f'name {i}' for i in range(n)], dtype=object)
+    })
+
+
+def test_compact_picks_the_smallest_lossless_dtypes():
+    df, usage = schema.compact_indexed(make_frame(), 'lat', 'lon')
+
+    assert df['lat'].dtype == np.float32 and df['lon'].dtype == np.float32
+    assert df['area'].dtype == np.float32
+    assert df['ratio'].dtype == np.float64
+    assert df['rooms'].dtype == np.int8
+    assert isinstance(df['kind'].dtype, pd.CategoricalDtype)
+    assert not isinstance(df['name'].dtype, pd.CategoricalDtype)
+    assert usage['after'] < usage['before']
+
+
+def test_compacted_values_stay_within_tolerance():
+    original = make_frame()
+
+    df, _ = schema.compact_indexed(original, 'lat', 'lon')
+
+    for name in ('lat', 'lon'):
+        assert np.abs(df[name].to_numpy(dtype=float) - original[name].to_numpy()).max() <= schema.COORDINATE_TOLERANCE
+    # float32 columns read back as the same decimals
+    for name in ('area', 'ratio', 'rooms'):
+        assert np.array_equal(df[name].to_numpy().astype(str).astype(float), original[name].to_numpy(dtype=float))
+    for name in ('kind', 'name'):
+        assert df[name].tolist() == original[name].tolist()
+
+
+def test_compacted_frame_serialises_the_same_records():
+    original = make_frame()
+    columns = ['area', 'ratio', 'rooms', 'kind', 'name']
+
+    df, _ = schema.compact_indexed(original, 'lat', 'lon')
+
+    serializer = RecordSerializer()
+    assert serializer.to_records(df[columns]) == serializer.to_records(original[columns])
+
+
+def test_coordinates_beyond_the_tolerance_are_kept():
+    df = pd.DataFrame({'lat': [51.123456789, 1e6 + 0.123456789]})
+
+    assert schema.compact(df, coordinates=['lat'])[0]['lat'].dtype == np.float64
+
+
+def test_missing_values_are_kept():
+    df = pd.DataFrame({'area': [173.3, np.nan, 80.5], 'kind': pd.Series(['a', None, 'a'], dtype=object)})
+
+    compacted, _ = schema.compact(df)
+
+    assert compacted['area'].dtype == np.float32
+    assert compacted['area'].isna().tolist() == [False, True, False]
+    assert compacted['kind'].isna().tolist() == [False, True, False]
+
+
+def test_compact_of_the_epc_dataset(datasets):
+    original = pd.read_parquet(io.BytesIO(datasets['london_epc.parquet']))
+
+    df, usage = schema.compact(original)
+
+    assert usage['after'] <= usage['before']
+    assert RecordSerializer().to_records(df.head(500)) == RecordSerializer().to_records(original.head(500))
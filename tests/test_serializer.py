@@ -0,0 +1,35 @@
+import json
+
+import numpy as np
+import pandas as pd
+from modules.serializer import RecordSerializer
+
+
+def make_frame():
+    return pd.DataFrame({
+        'name': pd.Series(['a', None, 'c'], dtype=object),
+        'count': np.array([1, 2, 3], dtype=np.int32),
+        'ratio': [0.5, np.nan, 2.0],
+        'area': np.array([173.3, np.nan, 1.5], dtype=np.float32),
+        'date': pd.to_datetime(['2020-01-01', None, '2021-06-30'])
+    })
+
+
+def test_records_match_to_json():
+    df = make_frame()
+
+    records = RecordSerializer().to_records(df)
+
+    assert records[1] == {'name': None, 'count': 2, 'ratio': None, 'area': None, 'date': None}
+    assert records[0]['area'] == 173.3
+    assert [{k: v for k, v in r.items() if k != 'area'} for r in records] == [
+        {k: v for k, v in r.items() if k != 'area'} for r in json.loads(df.to_json(orient='records'))]
+
+
+def test_every_projection_is_encoded_by_its_own_dtypes():
+    df = make_frame()
+    serializer = RecordSerializer()
+
+    for columns in (['count'], ['date', 'name'], ['ratio', 'count', 'area']):
+        assert serializer.to_records(df[columns]) == [{name: record[name] for name in columns}
+                                                      for record in serializer.to_records(df)]
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from modules.spatial_index import SpatialIndex
+from tests.stubs import haversine
+
+
+def make_coordinates(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(51.3, 51.7, n), rng.uniform(-0.5, 0.3, n)])
+
+
+def make_queries(seed=1):
+    return make_coordinates(50, seed)
+
+
+@pytest.mark.parametrize('radius', [100, 804, 5000])
+def test_radius_query_matches_haversine_scan(radius):
+    coordinates = make_coordinates(20000)
+    index = SpatialIndex(coordinates)
+
+    for central_point, rows in zip(make_queries(), index.query_radius(make_queries(), radius)):
+        distances = haversine(central_point, coordinates)
+        # Points within a rounding error of the radius may fall either side
+        certain = ~np.isclose(distances, radius, rtol=0, atol=1e-6)
+
+        assert np.array_equal(np.isin(np.flatnonzero(certain), rows), distances[certain] <= radius)
+        assert np.all(np.diff(rows) > 0)
+
+
+def test_radius_per_point():
+    coordinates = make_coordinates(5000)
+    radii = np.linspace(100, 3000, 50)
+
+    within = SpatialIndex(coordinates).query_radius(make_queries(), radii)
+
+    for central_point, radius, rows in zip(make_queries(), radii, within):
+        assert np.all(haversine(central_point, coordinates[rows]) <= radius + 1e-6)
+
+
+def test_nearest_query_matches_haversine_scan():
+    coordinates = make_coordinates(20000)
+
+    distances, indices = SpatialIndex(coordinates).query(make_queries(), k=5)
+
+    for central_point, found, rows in zip(make_queries(), distances, indices):
+        expected = np.sort(haversine(central_point, coordinates))[:5]
+
+        assert np.allclose(found, expected, rtol=0, atol=1e-6)
+        assert np.allclose(haversine(central_point, coordinates[rows]), expected, rtol=0, atol=1e-6)
+
+
+def test_coordinates_round_trip():
+    coordinates = make_coordinates(1000)
+
+    assert np.allclose(SpatialIndex(coordinates).get_coordinates(), coordinates, rtol=0, atol=1e-9)